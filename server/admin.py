@@ -0,0 +1,139 @@
+"""Maintenance commands for the Redis datastore.
+
+    python admin.py migrate    Convert the JSON layout of RedisDatastore to
+                               the packed one of PackedRedisDatastore
+    python admin.py purge      Finish background deletes left behind by
+                               stopped servers
+    python admin.py rebuild [agenda ...]
+                               Recompute the availability of the agendas,
+                               all of them by default
+
+Stop the API servers before running them.
+"""
+
+import re
+import sys
+
+from agenda import (ds, k, descendant_classes, AgendaController,
+                    RedisDatastore, PackedRedisDatastore)
+from dataobjects import Agenda, Shift, Appointment
+
+
+def scan(client, pattern, count=500):
+    """Batches of the keys matching ``pattern``, without blocking the server
+    like KEYS does.
+    """
+    cursor = 0
+    while True:
+        cursor, keys = client.execute_command('SCAN', cursor, 'MATCH', pattern,
+                                              'COUNT', count)
+        if keys:
+            yield keys
+        if int(cursor) == 0:
+            return
+
+
+def _max_length(client, collection_rkey):
+    starts = dict(client.zrange(collection_rkey, 0, -1, withscores=True))
+    ends = client.zrange(k(collection_rkey, "end"), 0, -1, withscores=True)
+    return max([int(end - starts[key]) for key, end in ends if key in starts]
+               or [0])
+
+
+def migrate(source, target, count=500):
+    """Move every object of ``source``, a RedisDatastore, to the packed
+    layout of ``target``, a PackedRedisDatastore on the same database.
+
+    Each batch is converted in one transaction, so the migration can be
+    interrupted and run again. Returns the number of objects moved.
+    """
+    client = target._rds
+    moved = 0
+    for cls in (Agenda, Shift, Appointment):
+        object_rkey = re.compile(r'^%s:(\d+)$' % cls.__name__)
+        for rkeys in scan(client, k(cls, "*"), count):
+            rkeys = [rkey for rkey in rkeys if object_rkey.match(rkey)]
+            if not rkeys:
+                continue
+            pipe = client.pipeline()
+            for rkey, payload in zip(rkeys, client.mget(rkeys)):
+                if payload == None:
+                    continue
+                key = object_rkey.match(rkey).group(1)
+                obj = source._load(cls, key, payload)
+                pipe.hset(target._bucket(cls, key), key, target._dumps(obj))
+                pipe.delete(rkey)
+                moved += 1
+            pipe.execute()
+
+    # Collections keep their zset by start. The one by end goes away, once
+    # it has been used to compute the max length of older collections.
+    for cls in (Agenda, Shift):
+        pattern = k(cls, "*", cls._collection_class, "end")
+        for rkeys in scan(client, pattern, count):
+            pipe = client.pipeline()
+            for rkey in rkeys:
+                collection_rkey = rkey[:-len(":end")]
+                if not client.exists(k(collection_rkey, "maxlen")):
+                    pipe.set(k(collection_rkey, "maxlen"),
+                             _max_length(client, collection_rkey))
+                pipe.delete(rkey)
+            pipe.execute()
+    return moved
+
+
+def purge(datastore, count=500):
+    """Purge every collection detached by delete_cascade in background.
+    Returns the number of collections purged.
+    """
+    purged = 0
+    for cls in descendant_classes(Agenda)[:-1]:
+        child_cls = cls._collection_class
+        for rkeys in scan(datastore._rds, k(cls, "*", child_cls, "deleting"),
+                          count):
+            for rkey in rkeys:
+                datastore.purge(child_cls, rkey)
+                purged += 1
+    return purged
+
+
+def agenda_keys(client, count=500):
+    """Keys of every agenda, in either layout."""
+    agenda_rkey = re.compile(r'^Agenda:(\d+)$')
+    bucket_rkey = re.compile(r'^Agenda:packed:\d+$')
+    for rkeys in scan(client, k(Agenda, "*"), count):
+        for rkey in rkeys:
+            if agenda_rkey.match(rkey):
+                yield agenda_rkey.match(rkey).group(1)
+            elif bucket_rkey.match(rkey):
+                for key in client.hkeys(rkey):
+                    yield key
+
+
+def rebuild(datastore, keys=None):
+    """Rebuild the availability of the agendas with ``keys``, or of all
+    of them. Returns the number of agendas rebuilt.
+    """
+    setattr(ds, 'datastore', datastore)
+    rebuilt = 0
+    for key in keys or agenda_keys(datastore._rds):
+        AgendaController(key).rebuild_availability()
+        rebuilt += 1
+    return rebuilt
+
+
+if __name__ == '__main__':
+    command, args = (sys.argv[1:2] or [None])[0], sys.argv[2:]
+    if command not in ("migrate", "purge", "rebuild") or (
+            args and command != "rebuild"):
+        print __doc__
+        sys.exit(1)
+    from server import REDIS, DATASTORE_CLASS
+    if command == "migrate":
+        source = RedisDatastore(**REDIS)
+        target = PackedRedisDatastore(connection_pool=source.connection_pool)
+        print "%d objects migrated" % migrate(source, target)
+    elif command == "purge":
+        print "%d collections purged" % purge(DATASTORE_CLASS(**REDIS))
+    else:
+        print "%d agendas rebuilt" % rebuild(DATASTORE_CLASS(**REDIS), args)
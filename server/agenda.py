@@ -1,9 +1,37 @@
-import json
+import hashlib
+import heapq
+import itertools
+import os
+import Queue
+import re
+import threading
+import time
+import warnings
+import zlib
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
 import redis
 
-from interval import interval_overlaps, slots_in_interval, Interval
+from bisect import bisect_left, bisect_right
+
+from interval import (interval_difference,
+                      is_slot, slots_in_intervals, slot_starts_in_window,
+                      slot_starts_in_intervals, slots_from_starts, Interval,
+                      IntervalIndex, numpy)
 from dataobjects import (Agenda, Shift, Appointment,
-                         CollectionDataobjectMixin, ParentkeyDataobjectMixin)
+                         CollectionDataobjectMixin, ParentkeyDataobjectMixin,
+                         JSONCodec, MsgpackCodec, StructCodec)
+
+
+# Candidate slots from which get_free_slots switches to the numpy path
+# (see ``python benchmark.py free_slots``)
+VECTORIZE_MIN_SLOTS = 1000
+
+# Shifts read per round trip by the pages of appointments and slots
+SHIFTS_BATCH_SIZE = 50
 
 
 class ConcurrencyWarning(Exception):
@@ -26,57 +54,379 @@ class NotAvailableSlotError(Exception):
     pass
 
 
-class Datastore(object):
+class SortedCollection(object):
+    """Children of a collection dataobject kept in (start, key) order.
+
+    Window queries bisect the start index. No member is longer than
+    ``max_length``, so every member overlapping a window starts within
+    ``max_length`` before it and a query costs O(log n + k).
+    """
 
     def __init__(self):
+        self._starts = []
+        self._keys = []
+        self._items = {}
+        self._max_length = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _position(self, start, key):
+        lo = bisect_left(self._starts, start)
+        hi = bisect_right(self._starts, start, lo)
+        return bisect_left(self._keys, key, lo, hi)
+
+    def add(self, key, item):
+        if key in self._items:
+            self.remove(key)
+        start = item.interval.start
+        pos = self._position(start, key)
+        self._starts.insert(pos, start)
+        self._keys.insert(pos, key)
+        self._items[key] = (start, item)
+        self._max_length = max(self._max_length,
+                               item.interval.end - item.interval.start)
+
+    def remove(self, key):
+        start, _ = self._items.pop(key)
+        pos = self._position(start, key)
+        del self._starts[pos]
+        del self._keys[pos]
+
+    def iteritems(self):
+        for key in self._keys:
+            yield key, self._items[key][1]
+
+    def iteritems_filter(self, start=None, end=None, after=None, limit=None):
+        """Members overlapping the window, at most ``limit`` of them
+        following the ``(start, key)`` of ``after``.
+        """
+        lo = 0 if start == None else bisect_right(self._starts,
+                                                  start - self._max_length)
+        hi = len(self._keys) if end == None else bisect_left(self._starts, end)
+        if after != None:
+            after_start, after_key = after
+            first = bisect_left(self._starts, after_start)
+            last = bisect_right(self._starts, after_start, first)
+            lo = max(lo, bisect_right(self._keys, after_key, first, last))
+        count = 0
+        for key in self._keys[lo:hi]:
+            if count == limit:
+                return
+            item = self._items[key][1]
+            if start == None or item.interval.end > start:
+                count += 1
+                yield key, item
+
+DAY = 24 * 3600
+
+UNALIGNED = "unaligned"
+
+
+class Availability(object):
+    """Free time of the shifts of agendas, per day, in cells of their
+    minimum length. AgendaController keeps it up to date so that free
+    slots are found without reading appointments.
+
+    A shift has a row for each day it spans, with the index of its first
+    cell in the day and a "1" (free) or "0" (booked) per cell. The state
+    of an agenda is the granularity its rows are kept at. Rows are only
+    written while it matches the minimum length, and free_gaps returns
+    None, so callers fall back to appointments, otherwise: before a reset
+    or rebuild, or once a shift or appointment is off the cells
+    ("unaligned").
+
+    Rows are updated after the writes, not with them. Every update counts
+    one write, and a reset or rebuild takes the version of the agenda
+    (see sync) as the count: free_gaps also returns None while the count
+    differs from the version, between a write and its update, or until a
+    rebuild once an update is lost (``python admin.py rebuild``).
+
+    Subclasses store states, counts and rows.
+    """
+
+    def reset(self, agenda):
+        """Start over, with no rows, at the granularity of ``agenda``."""
+        self._drop(agenda.key)
+        length = agenda.minimum_length
+        self._reset(agenda.key, str(length) if DAY % length == 0
+                                else UNALIGNED)
+
+    def drop(self, agenda):
+        self._drop(agenda.key)
+
+    def sync(self, agenda, version):
+        """Count the rows as up to date with ``version`` of ``agenda``,
+        once rebuilt from what was read at that version.
+        """
+        self._set_synced(agenda.key, version)
+
+    def _cells(self, interval, length):
+        """``(day, first cell, end cell)`` for each day ``interval`` spans."""
+        for day in range(interval.start // DAY, (interval.end - 1) // DAY + 1):
+            day_start = day * DAY
+            yield (day, (max(interval.start, day_start) - day_start) // length,
+                   (min(interval.end, day_start + DAY) - day_start) // length)
+
+    def _update(self, agenda, shift_key, interval, mode, flag="1"):
+        length = agenda.minimum_length
+        if interval.start % length or interval.end % length:
+            self._set_state(agenda.key, UNALIGNED)
+            return
+        self._write(agenda.key, str(length), shift_key, mode,
+                    list(self._cells(interval, length)), flag)
+
+    def add_shift(self, agenda, shift):
+        self._update(agenda, shift.key, shift.interval, "set")
+
+    def remove_shift(self, agenda, shift):
+        self._update(agenda, shift.key, shift.interval, "delete")
+
+    def book(self, agenda, appo):
+        self._update(agenda, appo.parent_key, appo.interval, "mark", "0")
+
+    def release(self, agenda, appo):
+        self._update(agenda, appo.parent_key, appo.interval, "mark", "1")
+
+    def free_gaps(self, agenda, start, end):
+        """The free parts of the shifts of ``agenda`` on the days from
+        ``start`` to ``end``, as _free_gaps, or None if it is not kept.
+        """
+        length = agenda.minimum_length
+        days = range(start // DAY, (end - 1) // DAY + 1)
+        state, synced, version, rows = self._read(agenda.key, days)
+        if state != str(length) or synced != version:
+            return None
+        gaps = {}
+        for day, day_rows in zip(days, rows):
+            for shift_key, row in day_rows.iteritems():
+                first, flags = row.split(":", 1)
+                origin = day * DAY + int(first) * length
+                shift_gaps = gaps.setdefault(shift_key, [])
+                for run in re.finditer("1+", flags):
+                    gap = Interval(origin + run.start() * length,
+                                   origin + run.end() * length)
+                    if shift_gaps and shift_gaps[-1].end == gap.start:
+                        # Free across midnight
+                        shift_gaps[-1] = Interval(shift_gaps[-1].start,
+                                                  gap.end)
+                    else:
+                        shift_gaps.append(gap)
+        return [gap for shift_gaps in gaps.itervalues() for gap in shift_gaps]
+
+
+class MemoryAvailability(Availability):
+    """Availability in dicts, with the rows of each agenda by day.
+    ``versions`` are those of the Datastore.
+    """
+
+    def __init__(self, versions):
+        self._versions = versions
+        self._states = {}
+        self._synced = {}
+        self._rows = {}
+
+    def _version(self, agenda_key):
+        return self._versions.get((Agenda.__name__, str(agenda_key)), 0)
+
+    def _reset(self, agenda_key, state):
+        self._states[agenda_key] = state
+        self._synced[agenda_key] = self._version(agenda_key)
+
+    def _set_state(self, agenda_key, state):
+        self._states[agenda_key] = state
+
+    def _set_synced(self, agenda_key, count):
+        self._synced[agenda_key] = count
+
+    def _drop(self, agenda_key):
+        self._states.pop(agenda_key, None)
+        self._synced.pop(agenda_key, None)
+        self._rows.pop(agenda_key, None)
+
+    def _write(self, agenda_key, state, shift_key, mode, cells, flag):
+        self._synced[agenda_key] = self._synced.get(agenda_key, 0) + 1
+        if self._states.get(agenda_key) != state:
+            return
+        days = self._rows.setdefault(agenda_key, {})
+        for day, first, end in cells:
+            rows = days.setdefault(day, {})
+            if mode == "set":
+                rows[shift_key] = "%d:%s" % (first, flag * (end - first))
+            elif mode == "delete":
+                rows.pop(shift_key, None)
+            elif shift_key in rows:
+                row_first, flags = rows[shift_key].split(":", 1)
+                lo = max(first - int(row_first), 0)
+                hi = min(end - int(row_first), len(flags))
+                rows[shift_key] = "%s:%s%s%s" % (row_first, flags[:lo],
+                                                 flag * (hi - lo), flags[hi:])
+
+    def _read(self, agenda_key, days):
+        rows = self._rows.get(agenda_key, {})
+        return (self._states.get(agenda_key), self._synced.get(agenda_key),
+                self._version(agenda_key), [rows.get(day, {}) for day in days])
+
+
+class Datastore(object):
+    """In memory datastore.
+
+    Objects are kept as they are put, or encoded by ``codec`` when one is
+    given so that gets return copies, as with RedisDatastore. Keys are
+    then strings, as there, for the parent keys the codecs decode.
+    """
+
+    def __init__(self, codec=None):
         self._items = {'Agenda': {}, 'Shift': {}, 'Appointment': {}}
         self._collection = {'Agenda': {}, 'Shift': {}, 'Appointment': {}}
+        self.codec = codec
+        self._versions = {}
+        self.availability = MemoryAvailability(self._versions)
+        self._sequence = itertools.count(1)
+
+    def defer(self, fn):
+        """Call ``fn`` now; units of work call it when they flush."""
+        fn()
+
+    def _key(self, key):
+        return str(key) if self.codec else key
+
+    def _incr_version(self, obj):
+        """Increment the version of the agenda ``obj`` is, or is under."""
+        while obj.__class__ != Agenda:
+            obj = self.get(obj.parent_class, obj.parent_key)
+        version_key = (Agenda.__name__, str(obj.key))
+        self._versions[version_key] = self._versions.get(version_key, 0) + 1
+
+    def get_version(self, cls, key):
+        """Version of the agenda with ``key``, incremented by every write
+        to it, its shifts and its appointments.
+        """
+        return self._versions.get((cls.__name__, str(key)), 0)
 
     def put(self, obj):
-        obj.key = id(obj)
-        self._items[obj.__class__.__name__][obj.key] = obj
+        if obj.key == None:
+            obj.key = next(self._sequence)
+        obj.key = self._key(obj.key)
         if issubclass(obj.__class__, ParentkeyDataobjectMixin):
             parent_obj = self.get(obj.parent_class, obj.parent_key)
-            self._collection[parent_obj.__class__.__name__][parent_obj.key][obj.key] = obj
+            collection = self._collection[parent_obj.__class__.__name__][parent_obj.key]
+            if obj.__class__ == Appointment:
+                for key, _ in collection.iteritems_filter(obj.interval.start,
+                                                          obj.interval.end):
+                    if key != obj.key:
+                        raise OverlappingIntervalWarning
+            collection.add(obj.key, obj)
+        if self.codec:
+            self._items[obj.__class__.__name__][obj.key] = self.codec.encode(obj)
+        else:
+            self._items[obj.__class__.__name__][obj.key] = obj
         if issubclass(obj.__class__, CollectionDataobjectMixin):
             if obj.key not in self._collection[obj.__class__.__name__]:
-                self._collection[obj.__class__.__name__][obj.key] = {}
-            self._set_collection_methods(obj)
+                self._collection[obj.__class__.__name__][obj.key] = SortedCollection()
+            obj.bind(self)
+        self._incr_version(obj)
         return obj
 
     def delete(self, cls, key):
+        key = self._key(key)
         obj = self.get(cls, key)
         if cls == Shift:
-            if list(obj.iteritems()):
+            if len(self._collection[cls.__name__][key]):
                 raise ShiftNotEmptyError
+        self._incr_version(obj)
         if issubclass(cls, ParentkeyDataobjectMixin):
             parent_obj = self.get(obj.parent_class, obj.parent_key)
             try:
-                del self._collection[parent_obj.__class__.__name__][parent_obj.key][obj.key]
+                self._collection[parent_obj.__class__.__name__][parent_obj.key].remove(obj.key)
             except KeyError:
                 pass
+        self._versions.pop((cls.__name__, str(key)), None)
         del self._items[cls.__name__][key]
         return
 
+    def put_many(self, objs):
+        """Put every object in ``objs``.
+
+        Returns, for each of them, the stored object or the exception that
+        kept it out (OverlappingIntervalWarning or KeyError for a missing
+        parent).
+        """
+        results = []
+        for obj in objs:
+            try:
+                results.append(self.put(obj))
+            except (OverlappingIntervalWarning, KeyError) as e:
+                results.append(e)
+        return results
+
+    def delete_many(self, cls, keys):
+        """Delete the objects of class ``cls`` with ``keys``. Nothing is
+        deleted if any of them is missing or is a non empty shift.
+        """
+        keys = [self._key(key) for key in keys]
+        for key in keys:
+            self.get(cls, key)
+            if cls == Shift and len(self._collection[cls.__name__][key]):
+                raise ShiftNotEmptyError
+        for key in keys:
+            self.delete(cls, key)
+
+    def delete_cascade(self, cls, key, background=False):
+        """Delete the object of class ``cls`` with ``key`` and everything
+        below it. ``background`` is accepted for compatibility with
+        RedisDatastore; deletes are always done here and now.
+        """
+        key = self._key(key)
+        obj = self.get(cls, key)
+        if cls != Agenda:
+            self._incr_version(obj)
+        if issubclass(cls, CollectionDataobjectMixin):
+            collection = self._collection[cls.__name__].pop(key, None)
+            for child_key, _ in list(collection.iteritems() if collection else ()):
+                self.delete_cascade(cls._collection_class, child_key)
+        if issubclass(cls, ParentkeyDataobjectMixin):
+            parent_collection = self._collection[obj.parent_class.__name__]
+            try:
+                parent_collection[obj.parent_key].remove(key)
+            except KeyError:
+                pass
+        self._versions.pop((cls.__name__, str(key)), None)
+        del self._items[cls.__name__][key]
+
     def get(self, cls, key):
+        key = self._key(key)
         obj = self._items[cls.__name__][key]
+        if self.codec:
+            obj = self.codec.decode(cls, obj)
+            obj.key = key
         if issubclass(obj.__class__, CollectionDataobjectMixin):
-            self._set_collection_methods(obj)
+            obj.bind(self)
         return obj
 
-    def _set_collection_methods(self, obj):
-        def _iter():
-            for key, item in self._collection[obj.__class__.__name__][obj.key].iteritems():
-                yield key, item
-        obj.set_iterator(_iter)
+    def _decoded(self, cls, items):
+        for key, _ in items:
+            yield key, self.get(cls, key)
+
+    def collection_iteritems(self, obj):
+        items = self._collection[obj.__class__.__name__][obj.key].iteritems()
+        if self.codec:
+            return self._decoded(obj.collection_class, items)
+        return items
 
-        def _filter(start=None, end=None):
-            start = start or 0
-            end = end or 2147483647
-            for key, item in self._collection[obj.__class__.__name__][obj.key].iteritems():
-                if item.interval.start < end and item.interval.end > start:
-                    yield key, item
-        obj.set_iteritems_filter(_filter)
+    def collection_iteritems_filter(self, obj, start=None, end=None):
+        return self.collection_iteritems_page(obj, start, end)
+
+    def collection_iteritems_page(self, obj, start=None, end=None, after=None,
+                                  limit=None):
+        """Children overlapping the window in (start, key) order, at most
+        ``limit`` of them following the ``(start, key)`` of ``after``.
+        """
+        collection = self._collection[obj.__class__.__name__][obj.key]
+        items = collection.iteritems_filter(start, end, after, limit)
+        if self.codec:
+            return self._decoded(obj.collection_class, items)
+        return items
 
 
 def to_key(obj):
@@ -90,111 +440,1427 @@ def k(*args):
     return ":".join([to_key(arg) for arg in args])
 
 
+class BlockingConnectionPool(redis.ConnectionPool):
+    """Thread-safe pool of at most ``max_connections`` connections.
+
+    When all of them are in use, ``get_connection`` waits up to
+    ``timeout`` seconds (forever if None) for one to be released, or
+    fails straight away if ``blocking`` is false.
+    """
+
+    def __init__(self, connection_class=redis.Connection, max_connections=50,
+                 timeout=20, blocking=True, **connection_kwargs):
+        self.connection_class = connection_class
+        self.connection_kwargs = connection_kwargs
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.blocking = blocking
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._connections = []
+        # None stands for a connection not made yet
+        self._available_connections = Queue.LifoQueue(self.max_connections)
+        for _ in range(self.max_connections):
+            self._available_connections.put_nowait(None)
+
+    def _checkpid(self):
+        if self.pid != os.getpid():
+            with self._lock:
+                if self.pid != os.getpid():
+                    self._reset()
+
+    def get_connection(self, command_name, *keys, **options):
+        self._checkpid()
+        try:
+            connection = self._available_connections.get(self.blocking,
+                                                         self.timeout)
+        except Queue.Empty:
+            raise redis.ConnectionError("No connection available.")
+        if connection == None:
+            connection = self.make_connection()
+        return connection
+
+    def make_connection(self):
+        connection = self.connection_class(**self.connection_kwargs)
+        with self._lock:
+            self._connections.append(connection)
+        return connection
+
+    def release(self, connection):
+        self._checkpid()
+        if connection.pid == self.pid:
+            self._available_connections.put_nowait(connection)
+
+    def disconnect(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.disconnect()
+
+
+class Script(object):
+    """Lua script run with EVALSHA, loaded again if the server lost it."""
+
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source).hexdigest()
+
+    def __call__(self, client, keys=(), args=()):
+        command = ('EVALSHA', self.sha, len(keys)) + tuple(keys) + tuple(args)
+        try:
+            return client.execute_command(*command)
+        except redis.ResponseError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+        self.load(client)
+        return client.execute_command(*command)
+
+    def load(self, client):
+        client.execute_command('SCRIPT', 'LOAD', self.source)
+
+
+# Keeps "<collection>:maxlen" at the length of the longest member ever
+# added, so range queries know how far back to look. Collections indexed
+# before it existed get it computed from their members once.
+_UPDATE_MAX_LENGTH = """
+local function update_max_length(by_start, by_end, max_key, length)
+    local current = redis.call('GET', max_key)
+    if not current then
+        current = 0
+        local starts = redis.call('ZRANGE', by_start, 0, -1, 'WITHSCORES')
+        for i = 1, #starts, 2 do
+            local member_end = redis.call('ZSCORE', by_end, starts[i])
+            if member_end then
+                current = math.max(current,
+                                   tonumber(member_end) - tonumber(starts[i + 1]))
+            end
+        end
+    end
+    redis.call('SET', max_key, math.max(tonumber(current), length))
+end
+"""
+
+# Agendas are written with their version incremented
+PUT_VERSIONED = Script("""
+-- KEYS: payload, version
+-- ARGV: payload
+redis.call('SET', KEYS[1], ARGV[1])
+redis.call('INCR', KEYS[2])
+""")
+
+# Writes to an agenda increment ``Agenda:<key>:version``. The agenda of
+# an appointment is read from the payload of its shift, decoded as the
+# codec named by the caller encoded it; ``shift_payload`` comes with the
+# layout.
+_VERSION_FUNCTIONS = """
+local function parent_of(payload, codec)
+    local parent
+    if codec == 'json' then
+        parent = cjson.decode(payload)['parent_key']
+    elseif codec == 'msgpack' then
+        parent = cmsgpack.unpack(payload)[3]
+    else
+        local _, _, struct_parent = struct.unpack('<i8i8i8', payload)
+        parent = struct_parent
+    end
+    if type(parent) == 'number' then
+        return string.format('%d', parent)
+    end
+    return parent
+end
+
+local function incr_version(parent_class, parent_key, codec)
+    if parent_class == 'Shift' then
+        local payload = shift_payload(parent_key)
+        if not payload then
+            return
+        end
+        parent_key = parent_of(payload, codec)
+    end
+    redis.call('INCR', 'Agenda:' .. parent_key .. ':version')
+end
+"""
+
+# Names the version scripts know the codecs by
+_SCRIPT_CODECS = ((JSONCodec, "json"), (MsgpackCodec, "msgpack"),
+                  (StructCodec, "struct"))
+
+
+def script_codec_name(codec):
+    """Name of ``codec`` in _VERSION_FUNCTIONS. Raises ValueError for the
+    codecs the scripts cannot read.
+    """
+    for cls, name in _SCRIPT_CODECS:
+        if isinstance(codec, cls):
+            return name
+    raise ValueError("%r cannot be read by the scripts" % codec)
+
+
+_SHIFT_PAYLOAD = """
+local function shift_payload(key)
+    return redis.call('GET', 'Shift:' .. key)
+end
+"""
+
+ADD_MEMBER = Script(_UPDATE_MAX_LENGTH + """
+-- KEYS: collection by start, by end, max length, member, parent version
+-- ARGV: start, end, member key, payload
+update_max_length(KEYS[1], KEYS[2], KEYS[3], ARGV[2] - ARGV[1])
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[3])
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[3])
+redis.call('SET', KEYS[4], ARGV[4])
+redis.call('INCR', KEYS[5])
+""")
+
+# BOOK_APPOINTMENT results
+BOOKED = 1
+OVERLAPPING = 0
+MISSING_PARENT = -1
+
+# Appointments of a shift never overlap, so only the last one starting
+# before the new one ends can overlap it. An appointment put again skips
+# its own entry, in the last two.
+BOOK_APPOINTMENT = Script(_UPDATE_MAX_LENGTH + _SHIFT_PAYLOAD +
+                          _VERSION_FUNCTIONS + """
+-- KEYS: shift, shift appointments by start, by end, max length, appointment
+-- ARGV: start, end, appointment key, payload, codec name, shift key
+-- Returns BOOKED, OVERLAPPING or MISSING_PARENT
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+local last = redis.call('ZREVRANGEBYSCORE', KEYS[2], '(' .. ARGV[2], '-inf',
+                        'LIMIT', 0, 2)
+local previous = last[1] ~= ARGV[3] and last[1] or last[2]
+if previous and
+   tonumber(redis.call('ZSCORE', KEYS[3], previous)) > tonumber(ARGV[1]) then
+    return 0
+end
+update_max_length(KEYS[2], KEYS[3], KEYS[4], ARGV[2] - ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[1], ARGV[3])
+redis.call('ZADD', KEYS[3], ARGV[2], ARGV[3])
+redis.call('SET', KEYS[5], ARGV[4])
+incr_version('Shift', ARGV[6], ARGV[5])
+return 1
+""")
+
+# Version increments of the deletes, queued in their transactions
+INCR_VERSION = Script(_SHIFT_PAYLOAD + _VERSION_FUNCTIONS + """
+-- ARGV: parent class name, parent key, codec name
+incr_version(ARGV[1], ARGV[2], ARGV[3])
+""")
+
+# Members overlapping a window, with their payloads, in start order. No
+# member is longer than max length, so none starting before
+# ``start - max length`` can reach the window. Pages resume after the
+# (start, member) of the last one and read the index in batches, stopping
+# once they are full.
+_RANGE_FUNCTIONS = """
+local function range(by_start, max_key, start, finish, after_start,
+                     after_member, limit, accept)
+    local low = '-inf'
+    local max_length = redis.call('GET', max_key)
+    if start ~= '-inf' and max_length then
+        low = '(' .. (tonumber(start) - tonumber(max_length))
+    end
+    if after_start ~= '' then
+        low = after_start
+    end
+    local high = finish
+    if high ~= '+inf' then
+        high = '(' .. high
+    end
+    limit = tonumber(limit)
+    local batch_size = limit and math.max(limit, 100) or -1
+    local result = {}
+    local offset = 0
+    repeat
+        local batch = redis.call('ZRANGEBYSCORE', by_start, low, high,
+                                 'WITHSCORES', 'LIMIT', offset, batch_size)
+        for i = 1, #batch, 2 do
+            local member = batch[i]
+            if after_start == '' or
+               tonumber(batch[i + 1]) > tonumber(after_start) or
+               member > after_member then
+                local payload = accept(member)
+                if payload then
+                    result[#result + 1] = member
+                    result[#result + 1] = payload
+                    if #result == 2 * (limit or -1) then
+                        return result
+                    end
+                end
+            end
+        end
+        offset = offset + batch_size
+    until batch_size == -1 or #batch < 2 * batch_size
+    return result
+end
+"""
+
+RANGE = Script(_RANGE_FUNCTIONS + """
+-- KEYS: collection by start, by end, max length
+-- ARGV: start or "-inf", end or "+inf", payload key prefix,
+--       start and key of the member to resume after or "", limit or ""
+-- Returns key, payload, key, payload...
+return range(KEYS[1], KEYS[3], ARGV[1], ARGV[2], ARGV[4], ARGV[5], ARGV[6],
+    function(member)
+        if ARGV[1] == '-inf' or tonumber(redis.call('ZSCORE', KEYS[2],
+                                                    member)) > tonumber(ARGV[1]) then
+            return redis.call('GET', ARGV[3] .. member)
+        end
+    end)
+""")
+
+def descendant_classes(cls):
+    """``cls`` followed by the class of its collection, and so on."""
+    classes = []
+    while cls:
+        classes.append(cls)
+        cls = getattr(cls, "_collection_class", None)
+    return tuple(classes)
+
+
+_CASCADE_DELETE = """
+-- KEYS: version of the agenda above the deleted object, if any
+-- ARGV: key, parent collection or "", collection to detach to or "",
+--       class names from the deleted object down to the leaves
+-- Returns the number of objects deleted, 0 when missing
+local function collection_of(depth, key)
+    return ARGV[depth + 3] .. ':' .. key .. ':' .. ARGV[depth + 4]
+end
+
+local deleted = 0
+local function delete(depth, key)
+    if ARGV[depth + 4] then
+        local collection = collection_of(depth, key)
+        for _, member in ipairs(redis.call('ZRANGE', collection, 0, -1)) do
+            delete(depth + 1, member)
+        end
+        redis.call('DEL', collection, collection .. ':end',
+                   collection .. ':maxlen')
+    end
+    delete_payload(ARGV[depth + 3], key)
+    deleted = deleted + 1
+end
+
+if ARGV[2] ~= '' then
+    redis.call('ZREM', ARGV[2], ARGV[1])
+    redis.call('ZREM', ARGV[2] .. ':end', ARGV[1])
+end
+if not payload_exists(ARGV[4], ARGV[1]) then
+    return 0
+end
+redis.call('DEL', ARGV[4] .. ':' .. ARGV[1] .. ':version')
+if KEYS[1] then
+    redis.call('INCR', KEYS[1])
+end
+if ARGV[3] ~= '' and ARGV[5] then
+    local collection = collection_of(1, ARGV[1])
+    if redis.call('EXISTS', collection) == 1 then
+        redis.call('RENAME', collection, ARGV[3])
+    end
+    redis.call('DEL', collection .. ':end', collection .. ':maxlen')
+    delete_payload(ARGV[4], ARGV[1])
+    return 1
+end
+delete(1, ARGV[1])
+return deleted
+"""
+
+# An object with all its descendants, or only the object itself with its
+# collection renamed for a later purge.
+CASCADE_DELETE = Script("""
+local function payload_exists(class, key)
+    return redis.call('EXISTS', class .. ':' .. key) == 1
+end
+
+local function delete_payload(class, key)
+    redis.call('DEL', class .. ':' .. key)
+end
+""" + _CASCADE_DELETE)
+
+
+class CountingStrictPipeline(redis.client.StrictPipeline):
+    """Pipeline adding its round trips to the client that created it."""
+
+    def __init__(self, client, *args, **kwargs):
+        super(CountingStrictPipeline, self).__init__(*args, **kwargs)
+        self._client = client
+
+    def immediate_execute_command(self, *args, **options):
+        self._client.round_trips += 1
+        return super(CountingStrictPipeline, self).immediate_execute_command(
+                                                            *args, **options)
+
+    def execute(self):
+        self._client.round_trips += 1
+        return super(CountingStrictPipeline, self).execute()
+
+
+class CountingStrictRedis(redis.StrictRedis):
+    """StrictRedis client counting round trips to the server."""
+
+    def __init__(self, *args, **kwargs):
+        super(CountingStrictRedis, self).__init__(*args, **kwargs)
+        self.round_trips = 0
+
+    def execute_command(self, *args, **options):
+        self.round_trips += 1
+        return super(CountingStrictRedis, self).execute_command(*args,
+                                                                **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountingStrictPipeline(self, self.connection_pool,
+                                      self.response_callbacks, transaction,
+                                      shard_hint)
+
+
+class KeyAllocator(object):
+    """Hands out keys from blocks of ids reserved with one INCRBY.
+
+    Ids come from ``shards`` counters. Id ``n`` of shard ``i`` becomes key
+    ``n * shards + i``, so shards never collide, and with a single shard
+    keys are the plain sequence. Objects passing the same ``hint`` (their
+    parent key) share a shard. Changing ``shards`` on a populated database
+    needs the counters seeded past the existing keys first.
+    """
+
+    def __init__(self, client, name='sequence.agenda', block_size=100,
+                 shards=1):
+        self._client = client
+        self.name = name
+        self.block_size = block_size
+        self.shards = shards
+        self._lock = threading.Lock()
+        self._blocks = {}
+        self._rotation = 0
+
+    def _counter(self, shard):
+        if self.shards == 1:
+            return self.name
+        return "%s:%d" % (self.name, shard)
+
+    def _shard(self, hint):
+        if hint == None:
+            self._rotation = (self._rotation + 1) % self.shards
+            return self._rotation
+        return zlib.crc32(str(hint)) % self.shards
+
+    def allocate(self, count=1, hint=None):
+        """Return a list of ``count`` new keys."""
+        ids = []
+        with self._lock:
+            shard = self._shard(hint)
+            next_id, last = self._blocks.get(shard, (1, 0))
+            while len(ids) < count:
+                if next_id > last:
+                    size = max(self.block_size, count - len(ids))
+                    last = self._client.incr(self._counter(shard), size)
+                    next_id = last - size + 1
+                taken = min(last - next_id + 1, count - len(ids))
+                ids.extend(range(next_id, next_id + taken))
+                next_id += taken
+            self._blocks[shard] = (next_id, last)
+        return [str(n * self.shards + shard) for n in ids]
+
+
+# Writes rows of an agenda availability for one day, if its state is still
+# the granularity they were computed at.
+WRITE_AVAILABILITY = Script("""
+-- KEYS: agenda state, agenda days, day rows
+-- ARGV: state, day, shift key, first cell, end cell, flag,
+--       "set", "delete" or "mark"
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[7] == 'delete' then
+    return redis.call('HDEL', KEYS[3], ARGV[3])
+end
+local first = tonumber(ARGV[4])
+local cells = tonumber(ARGV[5])
+if ARGV[7] == 'set' then
+    redis.call('SADD', KEYS[2], ARGV[2])
+    redis.call('HSET', KEYS[3], ARGV[3],
+               first .. ':' .. string.rep(ARGV[6], cells - first))
+    return 1
+end
+local row = redis.call('HGET', KEYS[3], ARGV[3])
+if not row then
+    return 0
+end
+local separator = string.find(row, ':', 1, true)
+local row_first = tonumber(string.sub(row, 1, separator - 1))
+local flags = string.sub(row, separator + 1)
+local lo = math.max(first - row_first, 0)
+local hi = math.min(cells - row_first, string.len(flags))
+redis.call('HSET', KEYS[3], ARGV[3],
+           row_first .. ':' .. string.sub(flags, 1, lo) ..
+           string.rep(ARGV[6], hi - lo) .. string.sub(flags, hi + 1))
+return 1
+""")
+
+
+# The count of a reset is the version of the agenda at that point
+RESET_AVAILABILITY = Script("""
+-- KEYS: agenda state, availability count, agenda version
+-- ARGV: state
+redis.call('SET', KEYS[1], ARGV[1])
+redis.call('SET', KEYS[2], redis.call('GET', KEYS[3]) or 0)
+""")
+
+
+class RedisAvailability(Availability):
+    """Availability in a hash per agenda and day, ``Agenda:<key>:
+    availability:<day>``, with a field per shift. The count of the writes
+    it is up to date with is ``Agenda:<key>:availability:synced``.
+    """
+
+    def __init__(self, client):
+        self._rds = client
+
+    def _reset(self, agenda_key, state):
+        RESET_AVAILABILITY(self._rds,
+            keys=(k(Agenda, agenda_key, "availability"),
+                  k(Agenda, agenda_key, "availability", "synced"),
+                  k(Agenda, agenda_key, "version")),
+            args=(state, ))
+
+    def _set_state(self, agenda_key, state):
+        self._rds.set(k(Agenda, agenda_key, "availability"), state)
+
+    def _set_synced(self, agenda_key, count):
+        self._rds.set(k(Agenda, agenda_key, "availability", "synced"), count)
+
+    def _drop(self, agenda_key):
+        days_rkey = k(Agenda, agenda_key, "availability", "days")
+        days = self._rds.smembers(days_rkey)
+        self._rds.delete(k(Agenda, agenda_key, "availability"), days_rkey,
+                         k(Agenda, agenda_key, "availability", "synced"),
+                         *[k(Agenda, agenda_key, "availability", day)
+                           for day in days])
+
+    def _write(self, agenda_key, state, shift_key, mode, cells, flag):
+        # The days and the count of the update in one transaction
+        pipe = self._rds.pipeline()
+        WRITE_AVAILABILITY.load(pipe)
+        for day, first, end in cells:
+            WRITE_AVAILABILITY(pipe,
+                keys=(k(Agenda, agenda_key, "availability"),
+                      k(Agenda, agenda_key, "availability", "days"),
+                      k(Agenda, agenda_key, "availability", day)),
+                args=(state, day, shift_key, first, end, flag, mode))
+        pipe.incr(k(Agenda, agenda_key, "availability", "synced"))
+        pipe.execute()
+
+    def _read(self, agenda_key, days):
+        pipe = self._rds.pipeline(transaction=False)
+        pipe.mget(k(Agenda, agenda_key, "availability"),
+                  k(Agenda, agenda_key, "availability", "synced"),
+                  k(Agenda, agenda_key, "version"))
+        for day in days:
+            pipe.hgetall(k(Agenda, agenda_key, "availability", day))
+        replies = pipe.execute()
+        state, synced, version = replies[0]
+        return state, int(synced or 0), int(version or 0), replies[1:]
+
+
 class RedisDatastore(object):
+    """Datastore on a Redis server.
 
-    def __init__(self):
-        redis_host = '127.0.0.1'
-        redis_port = 6379
-        redis_db = 0
-        self._rds = redis.StrictRedis(host=redis_host,
-                                      port=redis_port, db=redis_db)
+    Connections come from ``connection_pool`` if given, so that several
+    datastores can share them. Otherwise a BlockingConnectionPool is built
+    from the connection settings. New keys are reserved ``block_size`` at
+    a time from ``sequence_shards`` counters (see KeyAllocator). Payloads
+    are encoded by ``codec``, JSONCodec by default.
+    """
 
-    def _sequence(self):
-        return str(self._rds.incr('sequence.agenda'))
+    _scripts = (PUT_VERSIONED, ADD_MEMBER, BOOK_APPOINTMENT, INCR_VERSION)
+    _cascade_delete = CASCADE_DELETE
+    _incr_version = INCR_VERSION
+    _codec_class = JSONCodec
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, password=None,
+                 unix_socket_path=None, socket_timeout=None,
+                 max_connections=50, blocking=True, blocking_timeout=20,
+                 connection_pool=None, chunk_size=100, block_size=100,
+                 sequence_shards=1, codec=None):
+        if connection_pool == None:
+            kwargs = dict(db=db, password=password,
+                          socket_timeout=socket_timeout)
+            if unix_socket_path:
+                kwargs.update(path=unix_socket_path,
+                              connection_class=redis.UnixDomainSocketConnection)
+            else:
+                kwargs.update(host=host, port=port)
+            connection_pool = BlockingConnectionPool(
+                                    max_connections=max_connections,
+                                    timeout=blocking_timeout,
+                                    blocking=blocking, **kwargs)
+        self.connection_pool = connection_pool
+        self._rds = CountingStrictRedis(connection_pool=connection_pool)
+        self.chunk_size = chunk_size
+        self.codec = codec or self._codec_class()
+        self._codec_name = script_codec_name(self.codec)
+        self.availability = RedisAvailability(self._rds)
+        self._keys = KeyAllocator(self._rds, block_size=block_size,
+                                  shards=sequence_shards)
+
+    @property
+    def round_trips(self):
+        return self._rds.round_trips
+
+    def _sequence(self, obj):
+        return self._keys.allocate(1, getattr(obj, "parent_key", None))[0]
+
+    def defer(self, fn):
+        """Call ``fn`` now; units of work call it when they flush."""
+        fn()
+
+    def get_version(self, cls, key):
+        """Version of the agenda with ``key``, kept in
+        ``Agenda:<key>:version`` and incremented by the scripts and
+        transactions writing to it, its shifts and its appointments.
+        """
+        return int(self._rds.get(k(cls, key, "version")) or 0)
 
     def put(self, obj):
         if obj.key == None:
-            obj.key = self._sequence()
-        rkey = k(obj.__class__, obj.key)
-        payload = json.dumps(obj.to_dict())
+            obj.key = self._sequence(obj)
+        return self._put_result(obj, self._put_command(self._rds, obj))
 
-        if issubclass(obj.__class__, ParentkeyDataobjectMixin):
-            parent_rkey = k(obj.parent_class, obj.parent_key, obj.__class__)
-            # Here begins appointment overlapping control
-            if obj.__class__ == Appointment:
-                watch_rkey = k(obj.parent_class, obj.parent_key, obj.__class__)
-                pipe = self._rds.pipeline(transaction=True)
-                pipe.watch(watch_rkey)
-                start_rkey = watch_rkey
-                end_rkey = k(watch_rkey, "end")
-                start_after = self._rds.zrangebyscore(
-                                start_rkey, "-Inf", "(%d" % obj.interval.end)
-                end_before = self._rds.zrangebyscore(
-                                end_rkey, "(%d" % obj.interval.start, "+Inf")
-                overlapping = set(start_after) & set(end_before)
-                if overlapping != set():
-                    pipe.reset()
-                    raise OverlappingIntervalWarning
-                try:
-                    pipe.multi()
-                    pipe.zadd(parent_rkey, obj.interval.start, obj.key)
-                    pipe.zadd(k(parent_rkey, "end"), obj.interval.end, obj.key)
-                    pipe.execute()
-                except redis.WatchError:
-                    raise ConcurrencyWarning
-                finally:
-                    pipe.reset()
-            else:
-                self._rds.zadd(parent_rkey, obj.interval.start, obj.key)
-                self._rds.zadd(k(parent_rkey, "end"), obj.interval.end, obj.key)
+    def _put_command(self, client, obj):
+        """Issue on ``client``, a connection or a pipeline, the command
+        storing ``obj`` and return its reply.
+        """
+        rkey = k(obj.__class__, obj.key)
+        payload = self._dumps(obj)
+        if not issubclass(obj.__class__, ParentkeyDataobjectMixin):
+            return PUT_VERSIONED(client, keys=(rkey, k(rkey, "version")),
+                                 args=(payload, ))
+        parent_rkey = k(obj.parent_class, obj.parent_key, obj.__class__)
+        keys = (parent_rkey, k(parent_rkey, "end"), k(parent_rkey, "maxlen"),
+                rkey)
+        args = (obj.interval.start, obj.interval.end, obj.key, payload)
+        if obj.__class__ == Appointment:
+            # Overlap check, indexes and payload in one atomic step
+            return BOOK_APPOINTMENT(client,
+                    keys=(k(obj.parent_class, obj.parent_key), ) + keys,
+                    args=args + (self._codec_name, obj.parent_key))
+        version_rkey = k(obj.parent_class, obj.parent_key, "version")
+        return ADD_MEMBER(client, keys=keys + (version_rkey, ), args=args)
 
+    def _put_result(self, obj, reply):
+        if isinstance(reply, Exception):
+            raise reply
+        if obj.__class__ == Appointment:
+            if reply == OVERLAPPING:
+                raise OverlappingIntervalWarning
+            elif reply == MISSING_PARENT:
+                raise KeyError(obj.parent_key)
         if issubclass(obj.__class__, CollectionDataobjectMixin):
-            self._set_collection_methods(obj)
-        self._rds.set(rkey, payload)
+            obj.bind(self)
         return obj
 
+    def put_many(self, objs):
+        """Put every object in ``objs`` in at most two round trips: one
+        allocating the new keys, if the current block falls short, and one
+        pipelined transaction with all the writes.
+
+        Returns, for each of them, the stored object or the exception that
+        kept it out (OverlappingIntervalWarning or KeyError for a missing
+        parent).
+        """
+        objs = list(objs)
+        new = [obj for obj in objs if obj.key == None]
+        if new:
+            hint = getattr(new[0], "parent_key", None)
+            for key, obj in zip(self._keys.allocate(len(new), hint), new):
+                obj.key = key
+        pipe = self._rds.pipeline()
+        for script in self._scripts:
+            script.load(pipe)
+        for obj in objs:
+            self._put_command(pipe, obj)
+        results = []
+        replies = pipe.execute()[len(self._scripts):]
+        for obj, reply in zip(objs, replies):
+            try:
+                results.append(self._put_result(obj, reply))
+            except (OverlappingIntervalWarning, KeyError) as e:
+                results.append(e)
+        return results
+
     def delete(self, cls, key):
-        rkey = k(cls, key)
-        obj = None
+        self.delete_many(cls, [key])
+
+    def _queue_incr_version(self, pipe, cls, key, obj):
+        """Queue in ``pipe`` the version increment of deleting the object
+        of class ``cls`` with ``key``, decoded as ``obj``.
+        """
+        if issubclass(cls, ParentkeyDataobjectMixin):
+            self._incr_version.load(pipe)
+            self._incr_version(pipe, args=(obj.parent_class.__name__,
+                                           obj.parent_key, self._codec_name))
+        else:
+            pipe.delete(k(cls, key, "version"))
+
+    def delete_many(self, cls, keys):
+        """Delete the objects of class ``cls`` with ``keys`` in two round
+        trips, the second a transaction with the version increments.
+        Nothing is deleted if any of them is missing or is a non empty
+        collection.
+        """
+        keys = list(keys)
+        if not keys:
+            return
+        pipe = self._rds.pipeline(transaction=False)
+        pipe.mget([k(cls, key) for key in keys])
+        if issubclass(cls, CollectionDataobjectMixin):
+            for key in keys:
+                pipe.zcard(k(cls, key, cls._collection_class))
+        replies = pipe.execute()
+        payloads = replies[0]
+        if None in payloads:
+            raise KeyError(keys[payloads.index(None)])
+        if any(replies[1:]):
+            raise ShiftNotEmptyError
+
+        pipe = self._rds.pipeline()
+        for key, payload in zip(keys, payloads):
+            obj = self._load(cls, key, payload)
+            if issubclass(cls, ParentkeyDataobjectMixin):
+                parent_rkey = k(obj.parent_class, obj.parent_key, cls)
+                pipe.zrem(parent_rkey, key)
+                pipe.zrem(k(parent_rkey, "end"), key)
+            if issubclass(cls, CollectionDataobjectMixin):
+                pipe.delete(k(cls, key, cls._collection_class, "maxlen"))
+            self._queue_incr_version(pipe, cls, key, obj)
+            pipe.delete(k(cls, key))
+        pipe.execute()
+
+    def delete_cascade(self, cls, key, background=False):
+        """Delete the object of class ``cls`` with ``key`` and everything
+        below it, atomically, in one script run (two round trips when
+        ``cls`` has a parent). Raises KeyError if it is missing.
+
+        The script blocks the server while it runs. With ``background`` it
+        only deletes the object, detaching its collection, and returns a
+        started thread purging the children one at a time; they are no
+        longer listed but can still be got by key until purged. See also
+        ``python admin.py purge``.
+        """
+        parent_rkey = ""
+        version_rkeys = ()
         if issubclass(cls, ParentkeyDataobjectMixin):
             obj = self.get(cls, key)
             parent_rkey = k(obj.parent_class, obj.parent_key, cls)
-            self._rds.zrem(parent_rkey, key)
-            self._rds.zrem(k(parent_rkey, "end"), key)
-        if issubclass(cls, CollectionDataobjectMixin):
-            if not obj:
-                obj = self.get(cls, key)
-            collection_rkey = k(cls, key, obj.collection_class)
-            count = self._rds.zcard(collection_rkey)
-            if count != 0:
-                # FIX: raise specific exception
-                raise ShiftNotEmptyError
-        self._rds.delete(rkey)
-        return
+            while obj.parent_class != Agenda:
+                obj = self.get(obj.parent_class, obj.parent_key)
+            version_rkeys = (k(Agenda, obj.parent_key, "version"), )
+        classes = descendant_classes(cls)
+        detached = ""
+        if background and len(classes) > 1:
+            detached = k(cls, key, classes[1], "deleting")
+        args = (key, parent_rkey, detached) + tuple(c.__name__ for c in classes)
+        if not self._cascade_delete(self._rds, keys=version_rkeys,
+                                    args=args):
+            raise KeyError(key)
+        if detached:
+            thread = threading.Thread(target=self.purge,
+                                      args=(classes[1], detached))
+            thread.daemon = True
+            thread.start()
+            return thread
+
+    def purge(self, cls, detached):
+        """Delete the objects of class ``cls`` in the ``detached``
+        collection of delete_cascade, with their descendants.
+        """
+        while True:
+            keys = self._rds.zrange(detached, 0, self.chunk_size - 1)
+            if not keys:
+                break
+            for key in keys:
+                args = (key, detached, "") + tuple(
+                    c.__name__ for c in descendant_classes(cls))
+                self._cascade_delete(self._rds, keys=(), args=args)
 
     def get(self, cls, key):
         rkey = k(cls, key)
         payload = self._rds.get(rkey)
         if payload == None:
             raise KeyError
-        d = json.loads(payload)
-        obj = cls.from_dict(d)
+        return self._load(cls, key, payload)
+
+    def _dumps(self, obj):
+        return self.codec.encode(obj)
+
+    def _loads(self, cls, payload):
+        return self.codec.decode(cls, payload)
+
+    def _load(self, cls, key, payload):
+        obj = self._loads(cls, payload)
         obj.key = key
         if issubclass(obj.__class__, CollectionDataobjectMixin):
-            self._set_collection_methods(obj)
+            obj.bind(self)
         return obj
 
-    def _set_collection_methods(self, obj):
+    def _iter_get(self, cls, keys):
+        """Yield ``(key, obj)`` fetching payloads ``chunk_size`` at a time
+        with MGET. Keys deleted meanwhile are skipped.
+        """
+        for i in range(0, len(keys), self.chunk_size):
+            chunk = keys[i:i + self.chunk_size]
+            payloads = self._rds.mget([k(cls, key) for key in chunk])
+            for key, payload in zip(chunk, payloads):
+                if payload != None:
+                    yield key, self._load(cls, key, payload)
+
+    def collection_iteritems(self, obj):
+        collection_rkey = k(obj.__class__, obj.key, obj.collection_class)
+        keys = self._rds.zrangebyscore(collection_rkey, "-inf", "+inf")
+        for item in self._iter_get(obj.collection_class, keys):
+            yield item
+
+    def collection_iteritems_filter(self, obj, start=None, end=None):
+        return self.collection_iteritems_page(obj, start, end)
+
+    def _page_args(self, start, end, after, limit):
+        after_start, after_key = after if after != None else ("", "")
+        return ("-inf" if start == None else start,
+                "+inf" if end == None else end,
+                after_start, after_key, "" if limit == None else limit)
+
+    def collection_iteritems_page(self, obj, start=None, end=None, after=None,
+                                  limit=None):
+        """Children overlapping the window in (start, key) order, at most
+        ``limit`` of them following the ``(start, key)`` of ``after``.
+        """
+        collection_rkey = k(obj.__class__, obj.key, obj.collection_class)
+        args = self._page_args(start, end, after, limit)
+        reply = RANGE(self._rds,
+            keys=(collection_rkey, k(collection_rkey, "end"),
+                  k(collection_rkey, "maxlen")),
+            args=args[:2] + (k(obj.collection_class, ""),) + args[2:])
+        for key, payload in zip(reply[::2], reply[1::2]):
+            if payload != None:
+                yield key, self._load(obj.collection_class, key, payload)
+
+
+# Objects per payload hash, under the default hash-max-ziplist-entries
+# (128) so that buckets keep the compact encoding.
+BUCKET_SIZE = 100
+
+_PACKED_FUNCTIONS = """
+local function bucket(prefix, size, member)
+    return prefix .. math.floor(tonumber(member) / tonumber(size))
+end
+
+local function member_end(prefix, size, member)
+    local payload = redis.call('HGET', bucket(prefix, size, member), member)
+    if payload then
+        local _, member_end = struct.unpack('<i8i8', payload)
+        return member_end
+    end
+end
+
+local function update_max_length(by_start, max_key, prefix, size, length)
+    local current = redis.call('GET', max_key)
+    if not current then
+        current = 0
+        local starts = redis.call('ZRANGE', by_start, 0, -1, 'WITHSCORES')
+        for i = 1, #starts, 2 do
+            local finish = member_end(prefix, size, starts[i])
+            if finish then
+                current = math.max(current, finish - tonumber(starts[i + 1]))
+            end
+        end
+    end
+    redis.call('SET', max_key, math.max(tonumber(current), length))
+end
+"""
+
+PACKED_PUT_VERSIONED = Script("""
+-- KEYS: payload bucket, version
+-- ARGV: key, payload
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('INCR', KEYS[2])
+""")
+
+_PACKED_SHIFT_PAYLOAD = """
+local function shift_payload(key)
+    local bucket = 'Shift:packed:' .. math.floor(tonumber(key) / %d)
+    return redis.call('HGET', bucket, key)
+end
+""" % BUCKET_SIZE
+
+PACKED_ADD_MEMBER = Script(_PACKED_FUNCTIONS + """
+-- KEYS: collection by start, max length, member payload bucket,
+--       parent version
+-- ARGV: start, end, member key, payload, member bucket prefix, bucket size
+update_max_length(KEYS[1], KEYS[2], ARGV[5], ARGV[6], ARGV[2] - ARGV[1])
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[3])
+redis.call('HSET', KEYS[3], ARGV[3], ARGV[4])
+redis.call('INCR', KEYS[4])
+""")
+
+PACKED_BOOK_APPOINTMENT = Script(_PACKED_FUNCTIONS + _PACKED_SHIFT_PAYLOAD +
+                                 _VERSION_FUNCTIONS + """
+-- KEYS: shift payload bucket, shift appointments by start, max length,
+--       appointment payload bucket
+-- ARGV: start, end, appointment key, payload, appointment bucket prefix,
+--       bucket size, shift key
+-- Returns BOOKED, OVERLAPPING or MISSING_PARENT
+if redis.call('HEXISTS', KEYS[1], ARGV[7]) == 0 then
+    return -1
+end
+local last = redis.call('ZREVRANGEBYSCORE', KEYS[2], '(' .. ARGV[2], '-inf',
+                        'LIMIT', 0, 2)
+local previous = last[1] ~= ARGV[3] and last[1] or last[2]
+if previous then
+    local previous_end = member_end(ARGV[5], ARGV[6], previous)
+    if previous_end and previous_end > tonumber(ARGV[1]) then
+        return 0
+    end
+end
+update_max_length(KEYS[2], KEYS[3], ARGV[5], ARGV[6], ARGV[2] - ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[1], ARGV[3])
+redis.call('HSET', KEYS[4], ARGV[3], ARGV[4])
+incr_version('Shift', ARGV[7], 'struct')
+return 1
+""")
+
+PACKED_INCR_VERSION = Script(_PACKED_SHIFT_PAYLOAD + _VERSION_FUNCTIONS + """
+-- ARGV: parent class name, parent key, codec name
+incr_version(ARGV[1], ARGV[2], ARGV[3])
+""")
+
+PACKED_RANGE = Script(_PACKED_FUNCTIONS + _RANGE_FUNCTIONS + """
+-- KEYS: collection by start, max length
+-- ARGV: start or "-inf", end or "+inf", payload bucket prefix, bucket size,
+--       start and key of the member to resume after or "", limit or ""
+-- Returns key, payload, key, payload...
+return range(KEYS[1], KEYS[2], ARGV[1], ARGV[2], ARGV[5], ARGV[6], ARGV[7],
+    function(member)
+        local payload = redis.call('HGET', bucket(ARGV[3], ARGV[4], member),
+                                   member)
+        if payload then
+            local _, member_end = struct.unpack('<i8i8', payload)
+            if ARGV[1] == '-inf' or member_end > tonumber(ARGV[1]) then
+                return payload
+            end
+        end
+    end)
+""")
+
+PACKED_CASCADE_DELETE = Script("""
+local function bucket_of(class, key)
+    return class .. ':packed:' .. math.floor(tonumber(key) / %d)
+end
+
+local function payload_exists(class, key)
+    return redis.call('HEXISTS', bucket_of(class, key), key) == 1
+end
+
+local function delete_payload(class, key)
+    redis.call('HDEL', bucket_of(class, key), key)
+end
+""" % BUCKET_SIZE + _CASCADE_DELETE)
+
+
+class PackedRedisDatastore(RedisDatastore):
+    """RedisDatastore with a compact layout.
+
+    Payloads are fixed width binary records (see StructCodec) kept as
+    fields of hashes holding BUCKET_SIZE consecutive keys each, instead of
+    one JSON string per key. Collections keep only the zset by start: the
+    ends the range and booking scripts need are read from the payloads.
+    ``python admin.py migrate`` converts a database from the JSON layout.
+    """
+
+    _scripts = (PACKED_PUT_VERSIONED, PACKED_ADD_MEMBER,
+                PACKED_BOOK_APPOINTMENT, PACKED_INCR_VERSION)
+    _cascade_delete = PACKED_CASCADE_DELETE
+    _incr_version = PACKED_INCR_VERSION
+    # The scripts read intervals from the payloads: the codec must keep
+    # the StructCodec formats
+    _codec_class = StructCodec
+
+    def _bucket(self, cls, key):
+        try:
+            return k(cls, "packed", int(key) // BUCKET_SIZE)
+        except (TypeError, ValueError):
+            # Keys are integers in this layout
+            raise KeyError(key)
+
+    def _put_command(self, client, obj):
+        bucket = self._bucket(obj.__class__, obj.key)
+        if not issubclass(obj.__class__, ParentkeyDataobjectMixin):
+            return PACKED_PUT_VERSIONED(client,
+                    keys=(bucket, k(obj.__class__, obj.key, "version")),
+                    args=(obj.key, self._dumps(obj)))
+        parent_bucket = self._bucket(obj.parent_class, obj.parent_key)
+        parent_rkey = k(obj.parent_class, obj.parent_key, obj.__class__)
+        keys = (parent_rkey, k(parent_rkey, "maxlen"), bucket)
+        args = (obj.interval.start, obj.interval.end, obj.key,
+                self._dumps(obj), k(obj.__class__, "packed", ""), BUCKET_SIZE)
+        if obj.__class__ == Appointment:
+            return PACKED_BOOK_APPOINTMENT(client,
+                    keys=(parent_bucket, ) + keys, args=args + (obj.parent_key, ))
+        return PACKED_ADD_MEMBER(client, keys=keys + (
+                    k(obj.parent_class, obj.parent_key, "version"), ),
+                args=args)
+
+    def get(self, cls, key):
+        payload = self._rds.hget(self._bucket(cls, key), key)
+        if payload == None:
+            raise KeyError
+        return self._load(cls, key, payload)
+
+    def _queue_payloads(self, pipe, cls, keys):
+        """Queue one HMGET per bucket holding ``keys`` in ``pipe``; return
+        the fields asked in each of them, for _payloads.
+        """
+        buckets = {}
+        for key in keys:
+            buckets.setdefault(self._bucket(cls, key), []).append(key)
+        for bucket, fields in buckets.iteritems():
+            pipe.hmget(bucket, fields)
+        return buckets.values()
+
+    def _payloads(self, keys, fields, replies):
+        payloads = {}
+        for bucket_fields, values in zip(fields, replies):
+            payloads.update(zip(bucket_fields, values))
+        return [payloads[key] for key in keys]
+
+    def _get_payloads(self, cls, keys):
+        pipe = self._rds.pipeline(transaction=False)
+        fields = self._queue_payloads(pipe, cls, keys)
+        return self._payloads(keys, fields, pipe.execute())
+
+    def _iter_get(self, cls, keys):
+        for i in range(0, len(keys), self.chunk_size):
+            chunk = keys[i:i + self.chunk_size]
+            for key, payload in zip(chunk, self._get_payloads(cls, chunk)):
+                if payload != None:
+                    yield key, self._load(cls, key, payload)
+
+    def collection_iteritems_page(self, obj, start=None, end=None, after=None,
+                                  limit=None):
         collection_rkey = k(obj.__class__, obj.key, obj.collection_class)
+        args = self._page_args(start, end, after, limit)
+        reply = PACKED_RANGE(self._rds,
+            keys=(collection_rkey, k(collection_rkey, "maxlen")),
+            args=args[:2] + (k(obj.collection_class, "packed", ""),
+                             BUCKET_SIZE) + args[2:])
+        for key, payload in zip(reply[::2], reply[1::2]):
+            yield key, self._load(obj.collection_class, key, payload)
+
+    def delete(self, cls, key):
+        self.delete_many(cls, [key])
+
+    def delete_many(self, cls, keys):
+        keys = list(keys)
+        if not keys:
+            return
+        pipe = self._rds.pipeline(transaction=False)
+        fields = self._queue_payloads(pipe, cls, keys)
+        if issubclass(cls, CollectionDataobjectMixin):
+            for key in keys:
+                pipe.zcard(k(cls, key, cls._collection_class))
+        replies = pipe.execute()
+        payloads = self._payloads(keys, fields, replies[:len(fields)])
+        if None in payloads:
+            raise KeyError(keys[payloads.index(None)])
+        if any(replies[len(fields):]):
+            raise ShiftNotEmptyError
+
+        pipe = self._rds.pipeline()
+        for key, payload in zip(keys, payloads):
+            obj = self._load(cls, key, payload)
+            if issubclass(cls, ParentkeyDataobjectMixin):
+                pipe.zrem(k(obj.parent_class, obj.parent_key, cls), key)
+            if issubclass(cls, CollectionDataobjectMixin):
+                pipe.delete(k(cls, key, cls._collection_class, "maxlen"))
+            self._queue_incr_version(pipe, cls, key, obj)
+            pipe.hdel(self._bucket(cls, key), key)
+        pipe.execute()
+
+
+class CachedDatastore(object):
+    """In-process LRU cache of the objects of ``classes`` got from
+    ``datastore``, which serves everything else.
+
+    At most ``max_size`` objects are kept, for ``ttl`` seconds. Writes made
+    through the cache evict what they touch. With ``listen``, and a Redis
+    backed datastore, a thread also evicts the objects written by other
+    processes, following keyspace notifications. They must be enabled on
+    the server, with notify-keyspace-events including "Kg$h" or "KA";
+    otherwise a warning is issued and only the ttl applies. Cached objects
+    are shared by all callers.
+    """
+
+    def __init__(self, datastore, max_size=10000, ttl=30,
+                 classes=(Agenda, Shift), listen=True):
+        self.datastore = datastore
+        self.max_size = max_size
+        self.ttl = ttl
+        self.classes = tuple(classes)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Keys being read, with their readers and evictions meanwhile, so
+        # that gets racing with an eviction do not cache what they read
+        self._reads = {}
+        self._pubsub = None
+        if listen and hasattr(datastore, "_rds"):
+            self._listen()
+
+    def __getattr__(self, name):
+        return getattr(self.datastore, name)
+
+    def _listen(self):
+        rds = self.datastore._rds
+        try:
+            events = rds.config_get("notify-keyspace-events").get(
+                                            "notify-keyspace-events", "")
+        except redis.ResponseError:
+            # CONFIG is disabled: trust the server is set up
+            events = None
+        if events != None:
+            wanted = "K" if "A" in events else "Kg$h"
+            missing = "".join(flag for flag in wanted if flag not in events)
+            if missing:
+                warnings.warn("notify-keyspace-events lacks %r: cached "
+                              "objects are only refreshed after their ttl"
+                              % missing)
+                return
+        db = rds.connection_pool.connection_kwargs.get("db", 0)
+        self._pubsub = rds.pubsub()
+        self._pubsub.psubscribe(["__keyspace@%d__:%s:*" % (db, cls.__name__)
+                                 for cls in self.classes])
+        thread = threading.Thread(target=self._invalidate_from,
+                                  args=(self._pubsub, ))
+        thread.daemon = True
+        thread.start()
+
+    def _invalidate_from(self, pubsub):
+        try:
+            for message in pubsub.listen():
+                if message["type"] != "pmessage":
+                    continue
+                rkey = message["channel"].split(":", 1)[1].split(":")
+                if len(rkey) == 2:
+                    self.evict(rkey[0], rkey[1])
+                elif len(rkey) == 3 and rkey[1] == "packed":
+                    # A PackedRedisDatastore bucket
+                    first = int(rkey[2]) * BUCKET_SIZE
+                    for key in range(first, first + BUCKET_SIZE):
+                        self.evict(rkey[0], key)
+        except redis.ConnectionError:
+            # Closed, or lost: rely on the ttl
+            pass
+
+    def close(self):
+        """Stop following notifications."""
+        if self._pubsub:
+            self._pubsub.punsubscribe(list(self._pubsub.patterns))
+            self._pubsub = None
+
+    def evict(self, cls, key):
+        """Forget the object of class ``cls``, or its name, with ``key``."""
+        if isinstance(cls, type):
+            cls = cls.__name__
+        with self._lock:
+            self._evicted((cls, str(key)))
+
+    def _evicted(self, entry_key):
+        """Forget ``entry_key``; the caller holds the lock."""
+        self._entries.pop(entry_key, None)
+        if entry_key in self._reads:
+            self._reads[entry_key][1] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for read in self._reads.itervalues():
+                read[1] += 1
+
+    def get(self, cls, key):
+        if cls not in self.classes:
+            return self.datastore.get(cls, key)
+        entry_key = (cls.__name__, str(key))
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(entry_key, None)
+            if entry and entry[0] > now:
+                self._entries[entry_key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            read = self._reads.setdefault(entry_key, [0, 0])
+            read[0] += 1
+            evictions = read[1]
+        obj = None
+        try:
+            obj = self.datastore.get(cls, key)
+        finally:
+            with self._lock:
+                read[0] -= 1
+                if not read[0]:
+                    del self._reads[entry_key]
+                # Unless evicted while it was read, maybe this very object
+                if obj is not None and read[1] == evictions:
+                    self._entries[entry_key] = (now + self.ttl, obj)
+                    while len(self._entries) > self.max_size:
+                        self._entries.popitem(last=False)
+        return obj
+
+    def put(self, obj):
+        obj = self.datastore.put(obj)
+        self.evict(obj.__class__, obj.key)
+        return obj
+
+    def put_many(self, objs):
+        results = self.datastore.put_many(objs)
+        for obj in results:
+            if not isinstance(obj, Exception):
+                self.evict(obj.__class__, obj.key)
+        return results
+
+    def delete(self, cls, key):
+        self.datastore.delete(cls, key)
+        self.evict(cls, key)
 
-        def _iter():
-            for res in self._rds.zrangebyscore(collection_rkey, "-inf", "+inf"):
-                yield res, self.get(obj.collection_class, res)
-        obj.set_iterator(_iter)
+    def delete_many(self, cls, keys):
+        keys = list(keys)
+        self.datastore.delete_many(cls, keys)
+        for key in keys:
+            self.evict(cls, key)
 
-        def _filter(start=None, end=None):
-            start = "-Inf" if start == None else "(%s" % start
-            end = "+Inf" if end == None else "(%s" % end
-            start_rkey = collection_rkey
-            end_rkey = k(collection_rkey, "end")
-            start_after = self._rds.zrangebyscore(start_rkey, "-Inf", end)
-            end_before = self._rds.zrangebyscore(end_rkey, start, "+Inf")
-            for key in set(start_after) & set(end_before):
-                yield key, self.get(obj.collection_class, key)
-        obj.set_iteritems_filter(_filter)
+    def delete_cascade(self, cls, key, background=False):
+        result = self.datastore.delete_cascade(cls, key, background)
+        self.evict(cls, key)
+        # Children, which notifications would only evict later if at all
+        keys = set([str(key)])
+        for parent_cls, child_cls in zip(descendant_classes(cls),
+                                         descendant_classes(cls)[1:]):
+            with self._lock:
+                children = [entry_key for entry_key, (_, obj)
+                            in self._entries.iteritems()
+                            if entry_key[0] == child_cls.__name__ and
+                               str(obj.parent_key) in keys]
+                for entry_key in children:
+                    self._evicted(entry_key)
+            keys = set(entry_key[1] for entry_key in children)
+        return result
+
+
+class UnitOfWork(object):
+    """Identity map and write buffer over ``datastore`` for one scope.
+
+    Each object is loaded once and collection queries read to the end are
+    answered once, until a write touches them. Appointments are booked at once, so that
+    overlaps are still detected by the datastore. Other puts and deletes
+    are buffered until ``flush``, and only visible after it.
+
+    Objects stay bound to the datastore that loaded them, as they may be
+    shared, and outlive the unit: collection reads meant for the unit go
+    through ``ds().collection_iteritems...``.
+    """
+
+    def __init__(self, datastore):
+        self.datastore = datastore
+        self._identity = {}
+        self._listings = {}
+        self._streaming = {}
+        self._pending = []
+
+    def __getattr__(self, name):
+        return getattr(self.datastore, name)
+
+    def _register(self, cls, key, obj):
+        identity_key = (cls.__name__, str(key))
+        if identity_key in self._identity:
+            return self._identity[identity_key]
+        self._identity[identity_key] = obj
+        return obj
+
+    def _forget_listings(self, identity_key):
+        """Forget the collection queries of the object with
+        ``identity_key``, kept or being read.
+        """
+        for listings in (self._listings, self._streaming):
+            for listing_key in listings.keys():
+                if listing_key[:2] == identity_key:
+                    del listings[listing_key]
+
+    def _forget(self, cls, key):
+        self._identity.pop((cls.__name__, str(key)), None)
+        self._forget_listings((cls.__name__, str(key)))
+
+    def _changed(self, obj):
+        """Forget the collection queries of the parent of ``obj``."""
+        if issubclass(obj.__class__, ParentkeyDataobjectMixin):
+            self._forget_listings((obj.parent_class.__name__,
+                                   str(obj.parent_key)))
+
+    def get(self, cls, key):
+        identity_key = (cls.__name__, str(key))
+        if identity_key in self._identity:
+            return self._identity[identity_key]
+        return self._register(cls, key, self.datastore.get(cls, key))
+
+    def _listing(self, obj, start, end, items, page=()):
+        listing_key = (obj.__class__.__name__, str(obj.key), start, end) + page
+        if listing_key in self._listings:
+            return iter(self._listings[listing_key])
+        return self._stream(listing_key, obj.collection_class, items)
+
+    def _stream(self, listing_key, cls, items):
+        """Yield the children from ``items()``, registered as they come.
+        Kept for the next queries only if read to the end with no write
+        touching them meanwhile.
+        """
+        token = object()
+        self._streaming[listing_key] = token
+        listing = []
+        for key, child in items():
+            child = self._register(cls, key, child)
+            listing.append((key, child))
+            yield key, child
+        if self._streaming.get(listing_key) is token:
+            del self._streaming[listing_key]
+            self._listings[listing_key] = listing
+
+    def collection_iteritems(self, obj):
+        return self._listing(obj, None, None,
+                             lambda: self.datastore.collection_iteritems(obj))
+
+    def collection_iteritems_filter(self, obj, start=None, end=None):
+        return self._listing(obj, start, end,
+            lambda: self.datastore.collection_iteritems_filter(obj, start, end))
+
+    def collection_iteritems_page(self, obj, start=None, end=None, after=None,
+                                  limit=None):
+        return self._listing(obj, start, end,
+            lambda: self.datastore.collection_iteritems_page(obj, start, end,
+                                                             after, limit),
+            (after, limit))
+
+    def put(self, obj):
+        if obj.__class__ == Appointment:
+            obj = self.datastore.put(obj)
+            self._changed(obj)
+            return self._register(obj.__class__, obj.key, obj)
+        self._pending.append(("put", obj))
+        return obj
+
+    def put_many(self, objs):
+        self.flush()
+        results = self.datastore.put_many(objs)
+        for obj in results:
+            if not isinstance(obj, Exception):
+                self._changed(obj)
+                self._register(obj.__class__, obj.key, obj)
+        return results
+
+    def delete(self, cls, key):
+        self._pending.append(("delete", (cls, key)))
+
+    def delete_many(self, cls, keys):
+        for key in keys:
+            self.delete(cls, key)
+
+    def defer(self, fn):
+        """Call ``fn`` when the writes buffered so far are flushed."""
+        self._pending.append(("call", fn))
+
+    def delete_cascade(self, cls, key, background=False):
+        self.flush()
+        self._identity.clear()
+        self._listings.clear()
+        self._streaming.clear()
+        return self.datastore.delete_cascade(cls, key, background)
+
+    def flush(self):
+        """Write the buffered puts and deletes, and make the deferred calls,
+        in order, batching runs of puts and runs of deletes of the same
+        class. The first error is raised once its batch is done.
+        """
+        pending, self._pending = self._pending, []
+        while pending:
+            action, first = pending[0]
+            run = 1
+            while run < len(pending) and pending[run][0] == action and (
+                    action == "put" or
+                    action == "delete" and pending[run][1][0] == first[0]):
+                run += 1
+            batch, pending = [item for _, item in pending[:run]], pending[run:]
+            if action == "call":
+                first()
+            elif action == "put":
+                for obj in batch:
+                    self._changed(obj)
+                for obj in self.datastore.put_many(batch):
+                    if isinstance(obj, Exception):
+                        raise obj
+            else:
+                cls = first[0]
+                for _, key in batch:
+                    obj = self._identity.get((cls.__name__, str(key)))
+                    if obj:
+                        self._changed(obj)
+                    self._forget(cls, key)
+                self.datastore.delete_many(cls, [key for _, key in batch])
+
+    def discard(self, mark=0):
+        """Drop the writes buffered after the first ``mark`` ones."""
+        del self._pending[mark:]
+
+
+_scope = threading.local()
+
+
+@contextmanager
+def unit_of_work():
+    """Run the block in the UnitOfWork of the thread, opened if there is
+    none and closed with the block. Buffered writes are flushed when the
+    block ends, or those of the block discarded if it raises.
+    """
+    unit = getattr(_scope, "unit", None)
+    opened = unit == None
+    if opened:
+        unit = _scope.unit = UnitOfWork(ds())
+    mark = len(unit._pending)
+    try:
+        yield unit
+        unit.flush()
+    except:
+        unit.discard(mark)
+        raise
+    finally:
+        if opened:
+            _scope.unit = None
+
+
+def operation(method):
+    """Run ``method`` in a unit of work."""
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        with unit_of_work():
+            return method(*args, **kwargs)
+    return wrapper
 
 
 def ds():
+    unit = getattr(_scope, "unit", None)
+    if unit != None:
+        return unit
     if not hasattr(ds, "datastore"):
         ds.datastore = Datastore()
     return ds.datastore
@@ -202,107 +1868,346 @@ def ds():
 
 class AgendaController(object):
 
+    @operation
     def __init__(self, key=None, minimum_length=None):
         if key:
             self._agenda = ds().get(Agenda, key)
         else:
             self._agenda = Agenda(minimum_length)
             self._agenda = ds().put(self._agenda)
+            self._update_availability("reset")
 
     @property
     def key(self):
         return self._agenda.key
 
+    @property
+    def version(self):
+        """Incremented by every write to the agenda, its shifts and its
+        appointments.
+        """
+        return ds().get_version(Agenda, self.key)
+
+    def _update_availability(self, method, *args):
+        """Call ``method`` of the availability of the datastore with the
+        agenda and ``args`` once the writes so far are done.
+        """
+        def update():
+            getattr(ds().availability, method)(self._agenda, *args)
+        ds().defer(update)
+
+    @operation
+    def rebuild_availability(self):
+        """Recompute the availability of the agenda from its shifts and
+        appointments.
+        """
+        availability = ds().availability
+        version = self.version
+        availability.reset(self._agenda)
+        for _, shift in ds().collection_iteritems(self._agenda):
+            availability.add_shift(self._agenda, shift)
+            for _, appo in ds().collection_iteritems(shift):
+                availability.book(self._agenda, appo)
+        availability.sync(self._agenda, version)
+
     @property
     def minimum_length(self):
         return self._agenda.minimum_length
 
     @minimum_length.setter
+    @operation
     def minimum_length(self, value):
         self._agenda.minimum_length = value
         self._agenda = ds().put(self._agenda)
+        # Cells change with the minimum length
+        ds().defer(self.rebuild_availability)
 
+    @operation
     def add_shift(self, start, end):
         shift = Shift(self.key, start, end)
         shift = ds().put(shift)
+        self._update_availability("add_shift", shift)
         return shift
 
+    @operation
+    def add_shifts(self, intervals):
+        """Add a shift for every ``(start, end)`` in ``intervals``."""
+        shifts = ds().put_many([Shift(self.key, start, end)
+                                for start, end in intervals])
+        for shift in shifts:
+            if not isinstance(shift, Exception):
+                self._update_availability("add_shift", shift)
+        return shifts
+
+    @operation
     def del_shift(self, shift_key):
+        shift = ds().get(Shift, shift_key)
         ds().delete(Shift, shift_key)
+        self._update_availability("remove_shift", shift)
 
+    @operation
     def get_shift(self, shift_key):
         return ds().get(Shift, shift_key)
 
     def get_shifts_iteritems(self, start=None, end=None):
-        for key, shift in self._agenda.iteritems_filter(start, end):
+        for key, shift in ds().collection_iteritems_filter(self._agenda,
+                                                           start, end):
             yield (key, shift)
 
     def get_shifts_itervalues(self, start=None, end=None):
-        for _, shift in self._agenda.iteritems():
+        for _, shift in ds().collection_iteritems_filter(self._agenda,
+                                                         start, end):
             yield shift
 
+    def get_shifts_page(self, start=None, end=None, limit=None, after=None):
+        """Yield ``(key, shift)`` overlapping ``start`` and ``end`` by
+        start, at most ``limit`` of them. Pages follow each other passing
+        the ``(start, key)`` of the last shift as ``after``.
+        """
+        return ds().collection_iteritems_page(self._agenda, start, end, after,
+                                              limit)
+
+    def _iter_shift_batches(self, start=None, end=None):
+        """Yield ``(key, shift)`` as get_shifts_iteritems, read
+        SHIFTS_BATCH_SIZE at a time as they are consumed.
+        """
+        after = None
+        while True:
+            batch = list(self.get_shifts_page(start, end, SHIFTS_BATCH_SIZE,
+                                              after))
+            for item in batch:
+                yield item
+            if len(batch) < SHIFTS_BATCH_SIZE:
+                return
+            key, shift = batch[-1]
+            after = (shift.interval.start, key)
+
+    def _bookable(self, interval, shift):
+        return is_slot(interval, shift.interval, self.minimum_length)
+
+    @operation
     def add_appointment(self, start, end):
         appo = Appointment(None, start, end)
-        length = appo.interval.end - appo.interval.start
-        for _, shift in self._agenda.iteritems():
-            if appo.interval not in shift.interval:
-                continue
-            if appo.interval not in slots_in_interval(
-                                length, shift.interval, self.minimum_length):
+        for _, shift in self.get_shifts_iteritems(start, end):
+            if not self._bookable(appo.interval, shift):
                 continue
-            appos_in_shift = [a.interval for (_, a) in shift.iteritems()]
-            if not interval_overlaps(appo.interval, appos_in_shift):
+            if next(ds().collection_iteritems_filter(shift, start, end),
+                    None) is None:
                 appo.parent_key = shift.key
                 try:
                     appo = ds().put(appo)
-                except (OverlappingIntervalWarning, ConcurrencyWarning):
+                except (OverlappingIntervalWarning, ConcurrencyWarning,
+                        KeyError):
                     appo.parent_key = None
                     continue
+                self._update_availability("book", appo)
                 return appo
         raise NotAvailableSlotError
 
+    @operation
+    def add_appointments(self, intervals):
+        """Book an appointment for every ``(start, end)`` in ``intervals``.
+
+        Shifts are read once and all the bookings are written in one batch.
+        Returns, for each interval, the appointment or a
+        NotAvailableSlotError.
+        """
+        intervals = [Interval(start, end) for start, end in intervals]
+        if not intervals:
+            return []
+        start = min(i.start for i in intervals)
+        end = max(i.end for i in intervals)
+        shifts = [shift for _, shift in self.get_shifts_iteritems(start, end)]
+        booked = {}
+        planned = []
+        for interval in intervals:
+            for shift in shifts:
+                if not self._bookable(interval, shift):
+                    continue
+                if shift.key not in booked:
+                    appos = ds().collection_iteritems_filter(shift, start,
+                                                             end)
+                    booked[shift.key] = IntervalIndex(a.interval
+                                                      for _, a in appos)
+                if not booked[shift.key].overlaps(interval):
+                    booked[shift.key].add(interval)
+                    planned.append(Appointment(shift.key, interval.start,
+                                               interval.end))
+                    break
+            else:
+                planned.append(None)
+
+        stored = iter(ds().put_many([appo for appo in planned if appo]))
+        results = []
+        for interval, appo in zip(intervals, planned):
+            if appo == None:
+                appo = NotAvailableSlotError()
+            else:
+                appo = next(stored)
+            if isinstance(appo, (OverlappingIntervalWarning, KeyError)):
+                # Lost a race on its shift, try the others
+                try:
+                    appo = self.add_appointment(interval.start, interval.end)
+                except NotAvailableSlotError as e:
+                    appo = e
+            elif not isinstance(appo, Exception):
+                self._update_availability("book", appo)
+            results.append(appo)
+        return results
+
+    @operation
     def del_appointment(self, appo_key):
+        appo = ds().get(Appointment, appo_key)
         ds().delete(Appointment, appo_key)
+        self._update_availability("release", appo)
 
+    @operation
     def get_appointment(self, appo_key):
         return ds().get(Appointment, appo_key)
 
     def get_appointments_in_shift_iteritems(self, shift_key):
-        for key, appo in ds().get(Shift, shift_key).iteritems():
+        for key, appo in ds().collection_iteritems(ds().get(Shift, shift_key)):
             yield key, appo
 
     def get_appointments_iteritems(self, start=None, end=None):
-        for _, shift in self._agenda.iteritems_filter(start, end):
-            for key, appo in shift.iteritems_filter(start, end):
+        for _, shift in ds().collection_iteritems_filter(self._agenda,
+                                                         start, end):
+            for key, appo in ds().collection_iteritems_filter(shift, start,
+                                                              end):
                 yield key, appo
 
+    def get_slots(self, length=None, start=None, end=None, limit=None,
+                  after=None):
+        """Yield, lazily and by start, the slots of ``length`` every
+        minimum length from the start of the shifts, within ``start`` and
+        ``end``. Pages of ``limit`` slots follow each other passing the
+        start of the last one as ``after``.
+        """
+        length = length or self.minimum_length
+        if after != None:
+            start = after + 1 if start == None else max(start, after + 1)
+        starts = self._iter_slot_starts(length, start, end)
+        # Overlapping shifts share slots
+        unique = (s for s, _ in itertools.groupby(starts))
+        for s in itertools.islice(unique, limit):
+            yield Interval(s, s + length)
+
+    def _iter_slot_starts(self, length, start, end):
+        """Merge by start the slot starts of the shifts, read in batches
+        in order of start. No slot of a shift starts before it does, so a
+        shift is only opened once the starts before it have been yielded.
+        """
+        shifts = self._iter_shift_batches(start, end)
+        order = itertools.count()
+        heap = []
+        shift = next(shifts, (None, None))[1]
+        while True:
+            while shift != None and (not heap or
+                                     shift.interval.start <= heap[0][0]):
+                slot_starts = iter(slot_starts_in_window(
+                    length, shift.interval, self.minimum_length, start, end))
+                for s in itertools.islice(slot_starts, 1):
+                    heapq.heappush(heap, (s, next(order), slot_starts))
+                shift = next(shifts, (None, None))[1]
+            if not heap:
+                return
+            s, position, slot_starts = heap[0]
+            yield s
+            following = next(slot_starts, None)
+            if following == None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (following, position, slot_starts))
+
     def get_appointments_itervalues(self, start=None, end=None):
-        for _, shift in self._agenda.iteritems():
-            for _, appo in shift.iteritems():
-                yield appo
+        for _, appo in self.get_appointments_iteritems(start, end):
+            yield appo
+
+    def get_appointments_page(self, start=None, end=None, limit=None,
+                              after=None):
+        """Yield ``(key, appointment)`` overlapping ``start`` and ``end``
+        by start, at most ``limit`` of them. Pages follow each other
+        passing the ``(start, key)`` of the last appointment as ``after``.
 
+        Shifts are read in order of start, in batches, and each one is
+        only queried once the appointments before its start have been
+        yielded.
+        """
+        low = start if after == None else max(start, after[0])
+        shifts = self._iter_shift_batches(low, end)
+        heap = []
+        count = 0
+        shift = next(shifts, (None, None))[1]
+        while count != limit:
+            while shift != None and (not heap or
+                                     shift.interval.start <= heap[0][0]):
+                page = ds().collection_iteritems_page(shift, start, end,
+                                                      after, limit)
+                for key, appo in itertools.islice(page, 1):
+                    heapq.heappush(heap, (appo.interval.start, key, appo, page))
+                shift = next(shifts, (None, None))[1]
+            if not heap:
+                return
+            _, key, appo, page = heapq.heappop(heap)
+            for next_key, next_appo in itertools.islice(page, 1):
+                heapq.heappush(heap, (next_appo.interval.start, next_key,
+                                      next_appo, page))
+            count += 1
+            yield key, appo
+
+    def _free_gaps(self, start, end):
+        gaps = ds().availability.free_gaps(self._agenda, start, end)
+        if gaps != None:
+            return gaps
+        gaps = []
+        for _, shift in self.get_shifts_iteritems(start, end):
+            appos = sorted((a.interval for _, a
+                            in ds().collection_iteritems_filter(shift, start,
+                                                                end)),
+                           key=lambda i: i.start)
+            gaps.extend(interval_difference(shift.interval, appos))
+        return gaps
+
+    @operation
     def get_free_slots(self, start, end, length=None):
         """Return slots in shifts which does not overlaps with its
         appointments.
         """
         length = length or self.minimum_length
-        interval = Interval(start, end)
-        for slot in slots_in_interval(length, interval, length):
-            for shift_key, shift in self.get_shifts_iteritems():
-                if slot not in shift.interval:
-                    continue
-                overlapping_appointment = False
-                for _, appo in self.get_appointments_in_shift_iteritems(shift_key):
-                    if slot.overlaps(appo.interval):
-                        overlapping_appointment = True
-                        break
-                if overlapping_appointment == False:
-                    yield slot
-                    break
+        if numpy is not None and (end - start) // length >= VECTORIZE_MIN_SLOTS:
+            return slots_from_starts(
+                        self.get_free_slot_starts(start, end, length), length)
+        gaps = self._free_gaps(start, end)
+        return slots_in_intervals(length, Interval(start, end), gaps, length)
+
+    @operation
+    def get_free_slot_starts(self, start, end, length=None):
+        """Return the starts of the free slots as a numpy int64 array."""
+        length = length or self.minimum_length
+        gaps = self._free_gaps(start, end)
+        return slot_starts_in_intervals(length, Interval(start, end), gaps,
+                                        length)
+
+    @operation
+    def destroy(self, background=False):
+        """Delete the agenda with its shifts and appointments. See
+        delete_cascade for ``background``.
+        """
+        ds().availability.drop(self._agenda)
+        return ds().delete_cascade(Agenda, self.key, background)
+
+
+def common_free_slots(agendas, start, end, length=None):
+    """Yield, by start, the slots of ``length`` free in all ``agendas``.
 
-    def destroy(self):
-        for (key, shift) in list(self._agenda.iteritems()):
-            for (appo_key, _) in list(shift.iteritems()):
-                ds().delete(Appointment, appo_key)
-            ds().delete(Shift, key)
-        ds().delete(Agenda, self.key)
+    Their free slots are generated lazily on the same grid, from
+    ``start``, and merged: a slot is common when all of them yield it.
+    ``length`` defaults to the greatest minimum length.
+    """
+    length = length or max(agenda.minimum_length for agenda in agendas)
+    starts = heapq.merge(*[(slot.start for slot
+                            in agenda.get_free_slots(start, end, length))
+                           for agenda in agendas])
+    for s, group in itertools.groupby(starts):
+        if sum(1 for _ in group) == len(agendas):
+            yield Interval(s, s + length)
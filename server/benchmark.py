@@ -0,0 +1,322 @@
+"""Micro-benchmarks for the agenda server.
+
+Run ``python benchmark.py`` for all of them or pass their names.
+"""
+
+import sys
+import threading
+import time
+import timeit
+import types
+
+from dataobjects import Agenda, Shift, Appointment, CollectionDataobjectMixin
+from interval import (Interval, interval_difference, slots_in_intervals,
+                      slot_starts_in_intervals, slots_from_starts, numpy)
+
+
+DAY = 24 * 3600
+
+
+def best_of(fn, number=1, repeat=5):
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def free_gaps(days, length=1800):
+    """Free gaps of an agenda with two shifts a day, half of them booked."""
+    gaps = []
+    for day in range(days):
+        for start, end in ((9, 14), (16, 19)):
+            shift = Interval(day * DAY + start * 3600, day * DAY + end * 3600)
+            appos = [Interval(s, s + length)
+                     for s in range(shift.start, shift.end, 2 * length)]
+            gaps.extend(interval_difference(shift, appos))
+    return gaps
+
+
+def bench_free_slots():
+    """Pure-Python sweep against the numpy path at 5 minute granularity."""
+    if numpy is None:
+        print "numpy is not installed"
+        return
+    length = 300
+    print "%6s %10s %8s %12s %12s %12s" % ("days", "candidates", "slots",
+                                           "python", "numpy", "numpy+adapt")
+    for days in (1, 2, 4, 8, 16, 31, 92):
+        gaps = free_gaps(days)
+        interval = Interval(0, days * DAY)
+
+        def python():
+            return list(slots_in_intervals(length, interval, gaps))
+
+        def vectorized():
+            return slot_starts_in_intervals(length, interval, gaps)
+
+        def adapted():
+            return list(slots_from_starts(vectorized(), length))
+
+        print "%6d %10d %8d %10.2fms %10.2fms %10.2fms" % (
+            days, days * DAY // length, len(python()), best_of(python) * 1000,
+            best_of(vectorized) * 1000, best_of(adapted) * 1000)
+
+
+class DictInterval(object):
+    """Interval as it was before __slots__."""
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+
+def dict_layout(cls):
+    """Subclass of ``cls`` laid out as dataobjects were before __slots__:
+    an instance dict, a dict based Interval and, for collections, a
+    private dict plus two closures per instance.
+    """
+    def __init__(self, *args, **kwargs):
+        cls.__init__(self, *args, **kwargs)
+        if hasattr(self, "_interval"):
+            self._interval = DictInterval(self._interval.start,
+                                          self._interval.end)
+        if issubclass(cls, CollectionDataobjectMixin):
+            self._collection = {}
+
+            def iteritems():
+                for item in self._collection.iteritems():
+                    yield item
+            self.iteritems = iteritems
+
+            def iteritems_filter(start=None, end=None):
+                for item in self._collection.iteritems():
+                    yield item
+            self.iteritems_filter = iteritems_filter
+    return type("Dict" + cls.__name__, (cls,), {"__init__": __init__})
+
+
+def deep_size(obj, seen=None):
+    """Bytes held by ``obj`` and the per-instance objects it references."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen or isinstance(obj, (type, int, long)) or obj is None:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, types.FunctionType):
+        for cell in obj.func_closure or ():
+            size += sys.getsizeof(cell)
+    else:
+        if hasattr(obj, "__dict__"):
+            size += deep_size(obj.__dict__, seen)
+        for cls in type(obj).__mro__:
+            for name in cls.__dict__.get("__slots__", ()):
+                size += deep_size(getattr(obj, name, None), seen)
+    return size
+
+
+def bench_dataobjects():
+    """Memory and construction time of __slots__ against dict layouts."""
+    count = 10000
+    print "%12s %8s %8s %12s %12s" % ("class", "size", "(dict)", "build",
+                                      "(dict)")
+    for cls, args in ((Appointment, (1, 9, 10)), (Shift, (1, 9, 14)),
+                      (Agenda, (1800, ))):
+        legacy = dict_layout(cls)
+
+        def build_slots():
+            return [cls(*args) for _ in xrange(count)]
+
+        def build_dict():
+            return [legacy(*args) for _ in xrange(count)]
+
+        print "%12s %7dB %7dB %9.2fus %9.2fus" % (
+            cls.__name__, deep_size(cls(*args)), deep_size(legacy(*args)),
+            best_of(build_slots) * 1e6 / count,
+            best_of(build_dict) * 1e6 / count)
+
+
+def bench_keys():
+    """Agenda puts per second against a local redis-server by key block."""
+    from agenda import RedisDatastore
+    count = 4000
+    print "%10s %8s %12s %12s" % ("block_size", "threads", "puts/s",
+                                  "round trips")
+    for block_size in (1, 10, 100, 1000):
+        for threads in (1, 8):
+            datastore = RedisDatastore(block_size=block_size)
+            objs = [Agenda() for _ in xrange(count)]
+
+            def worker(objs):
+                for obj in objs:
+                    datastore.put(obj)
+
+            workers = [threading.Thread(target=worker, args=(objs[i::threads], ))
+                       for i in range(threads)]
+            started = time.time()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            elapsed = time.time() - started
+            print "%10d %8d %12.0f %12d" % (block_size, threads,
+                                            count / elapsed,
+                                            datastore.round_trips)
+            datastore.delete_many(Agenda, [obj.key for obj in objs])
+
+
+def bench_layout_memory():
+    """Redis memory per object in the JSON and the packed layouts."""
+    from agenda import RedisDatastore, PackedRedisDatastore
+    agendas, days = 20, 31
+    print "%8s %10s %12s %14s" % ("layout", "objects", "used memory",
+                                  "bytes/object")
+    for name, cls in (("json", RedisDatastore),
+                      ("packed", PackedRedisDatastore)):
+        # A database of its own so that the delta is only ours
+        datastore = cls(db=2)
+        rds = datastore._rds
+        rds.flushdb()
+        before = rds.info()["used_memory"]
+        objs = []
+        for _ in range(agendas):
+            agenda = datastore.put(Agenda())
+            shifts = datastore.put_many(
+                Shift(agenda.key, day * DAY + start * 3600,
+                      day * DAY + end * 3600)
+                for day in range(days) for start, end in ((9, 14), (16, 19)))
+            appos = datastore.put_many(
+                Appointment(shift.key, start, start + 1800)
+                for shift in shifts
+                for start in range(shift.interval.start, shift.interval.end,
+                                   3600))
+            objs.extend([agenda] + shifts + appos)
+        used = rds.info()["used_memory"] - before
+        print "%8s %10d %10.1fMB %14.1f" % (name, len(objs), used / 1e6,
+                                            float(used) / len(objs))
+        rds.flushdb()
+
+
+def bench_codecs():
+    """Encode and decode time per appointment by codec."""
+    import json
+    from dataobjects import JSONCodec, MsgpackCodec, StructCodec, msgpack
+    appos = [Appointment(str(i), i * 1800, i * 1800 + 900)
+             for i in xrange(10000)]
+
+    class ToDict(object):
+        """The former payloads: to_dict() and from_dict() through JSON."""
+
+        def encode(self, obj):
+            return json.dumps(obj.to_dict())
+
+        def decode(self, cls, payload):
+            return cls.from_dict(json.loads(payload))
+
+    codecs = [("to_dict", ToDict()), ("json", JSONCodec())]
+    if msgpack is not None:
+        codecs.append(("msgpack", MsgpackCodec()))
+    codecs.append(("struct", StructCodec()))
+    print "%8s %12s %12s %8s" % ("codec", "encode", "decode", "bytes")
+    for name, codec in codecs:
+        payloads = [codec.encode(appo) for appo in appos]
+
+        def encode():
+            for appo in appos:
+                codec.encode(appo)
+
+        def decode():
+            for payload in payloads:
+                codec.decode(Appointment, payload)
+
+        print "%8s %10.2fus %10.2fus %8d" % (
+            name, best_of(encode) * 1e6 / len(appos),
+            best_of(decode) * 1e6 / len(appos), len(payloads[0]))
+
+
+def bench_availability():
+    """One day of free slots from availability rows and from appointments."""
+    from agenda import ds, RedisDatastore, AgendaController
+    setattr(ds, 'datastore', RedisDatastore())
+    length = 900
+    agenda = AgendaController(minimum_length=length)
+    for day in range(31):
+        for start, end in ((9, 14), (16, 19)):
+            shift = agenda.add_shift(day * DAY + start * 3600,
+                                     day * DAY + end * 3600)
+            agenda.add_appointments(
+                (s, s + length) for s in range(shift.interval.start,
+                                               shift.interval.end, 2 * length))
+
+    def day_of_slots():
+        return list(agenda.get_free_slots(15 * DAY, 16 * DAY, length))
+
+    slots = len(day_of_slots())
+    with_rows = best_of(day_of_slots, number=20)
+    trips = ds().round_trips
+    day_of_slots()
+    trips = ds().round_trips - trips
+    ds().availability.drop(agenda._agenda)
+    without_rows = best_of(day_of_slots, number=20)
+    fallback_trips = ds().round_trips
+    day_of_slots()
+    fallback_trips = ds().round_trips - fallback_trips
+    print "%14s %8s %10s %12s" % ("", "slots", "time", "round trips")
+    print "%14s %8d %8.2fms %12d" % ("availability", slots, with_rows * 1000,
+                                     trips)
+    print "%14s %8d %8.2fms %12d" % ("appointments", slots,
+                                     without_rows * 1000, fallback_trips)
+    agenda.destroy()
+
+
+def bench_render_epoch():
+    """Rendering of a month of 5 minute slot bounds by render_epoch."""
+    import pytz
+    import server
+    epochs = range(0, 31 * DAY, 300)
+
+    def uncached():
+        """render_epoch as it was."""
+        for an_epoch in epochs:
+            localtz = pytz.timezone(server.DEFAULT_TZ)
+            dt = server.epoch2datetime(an_epoch)
+            server.OrderedDict((
+                ("datetime", dt.strftime(server.UTCTIMEFORMAT)),
+                ("timestamp", an_epoch),
+                ("localtime",
+                 dt.astimezone(localtz).strftime(server.LOCALTIMEFORMAT)),
+                ("timezone", server.DEFAULT_TZ)
+            ))
+
+    def cold():
+        server._rendered_epochs.clear()
+        server._day_offsets.clear()
+        for an_epoch in epochs:
+            server.render_epoch(an_epoch)
+
+    def memoized():
+        for an_epoch in epochs:
+            server.render_epoch(an_epoch)
+
+    print "%10s %10s" % ("", "per epoch")
+    for name, fn in (("uncached", uncached), ("cold", cold),
+                     ("memoized", memoized)):
+        print "%10s %8.2fus" % (name, best_of(fn) * 1e6 / len(epochs))
+
+
+BENCHMARKS = (
+    ("free_slots", bench_free_slots),
+    ("dataobjects", bench_dataobjects),
+    ("keys", bench_keys),
+    ("layout_memory", bench_layout_memory),
+    ("codecs", bench_codecs),
+    ("availability", bench_availability),
+    ("render_epoch", bench_render_epoch),
+)
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or [name for name, _ in BENCHMARKS]
+    for name, bench in BENCHMARKS:
+        if name in names:
+            print "== %s: %s" % (name, bench.__doc__)
+            bench()
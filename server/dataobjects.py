@@ -1,7 +1,19 @@
+import json
+from operator import attrgetter
+import struct
+
 from interval import Interval
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 class IBaseDataobject(object):
+    # Mixins declare no slots of their own; every concrete dataobject
+    # lists the full set so instances carry no __dict__.
+    __slots__ = ()
     _fields = []
 
     @classmethod
@@ -27,6 +39,7 @@ class IBaseDataobject(object):
 
 
 class IntervalDataobjectMixin(IBaseDataobject):
+    __slots__ = ()
 
     def __init__(self, start, end, *args, **kwargs):
         super(IntervalDataobjectMixin, self).__init__(*args, **kwargs)
@@ -45,37 +58,42 @@ class IntervalDataobjectMixin(IBaseDataobject):
 
 
 class CollectionDataobjectMixin(IBaseDataobject):
-
+    """Dataobject whose children are iterated through the datastore it was
+    bound to by ``put`` or ``get``.
+    """
+    __slots__ = ()
     _collection_class = None
 
     def __init__(self, *args, **kwargs):
         super(CollectionDataobjectMixin, self).__init__(*args, **kwargs)
-        self._collection = {}
-
-        def iteritems():
-            for item in self._collection.iteritems():
-                yield item
-        self.iteritems = iteritems
-
-        def iteritems_filter(start=None, end=None):
-            for item in self._collection.iteritems():
-                if item in range(start, end):
-                    yield item
-        self.iteritems_filter = iteritems_filter
+        self._datastore = None
 
     @property
     def collection_class(self):
         return self._collection_class
 
-    def set_iterator(self, callback):
-        self.iteritems = callback
+    def bind(self, datastore):
+        self._datastore = datastore
 
-    def set_iteritems_filter(self, callback):
-        self.iteritems_filter = callback
+    def iteritems(self):
+        if self._datastore is None:
+            return iter(())
+        return self._datastore.collection_iteritems(self)
 
+    def iteritems_filter(self, start=None, end=None):
+        if self._datastore is None:
+            return iter(())
+        return self._datastore.collection_iteritems_filter(self, start, end)
 
-class ParentkeyDataobjectMixin(IBaseDataobject):
+    def iteritems_page(self, start=None, end=None, after=None, limit=None):
+        if self._datastore is None:
+            return iter(())
+        return self._datastore.collection_iteritems_page(self, start, end,
+                                                         after, limit)
 
+
+class ParentkeyDataobjectMixin(IBaseDataobject):
+    __slots__ = ()
     _parent_class = None
 
     def __init__(self, parent_key, *args, **kwargs):
@@ -102,6 +120,7 @@ class ParentkeyDataobjectMixin(IBaseDataobject):
 
 class Appointment(ParentkeyDataobjectMixin, IntervalDataobjectMixin,
                   IBaseDataobject):
+    __slots__ = ("_key", "_parent_key", "_interval")
 
     def __init__(self, *args, **kwargs):
         super(Appointment, self).__init__(*args, **kwargs)
@@ -109,6 +128,7 @@ class Appointment(ParentkeyDataobjectMixin, IntervalDataobjectMixin,
 
 class Shift(ParentkeyDataobjectMixin, IntervalDataobjectMixin,
             CollectionDataobjectMixin, IBaseDataobject):
+    __slots__ = ("_key", "_parent_key", "_interval", "_datastore")
     _collection_class = Appointment
 
     def __init__(self, *args, **kwargs):
@@ -116,6 +136,7 @@ class Shift(ParentkeyDataobjectMixin, IntervalDataobjectMixin,
 
 
 class Agenda(CollectionDataobjectMixin, IBaseDataobject):
+    __slots__ = ("_key", "_datastore", "_minimun_length")
     _fields = ["minimum_length", ]
     _collection_class = Shift
 
@@ -136,3 +157,156 @@ Shift._parent_class = Agenda
 Appointment._parent_class = Shift
 Shift._collection_class = Appointment
 Agenda._collection_class = Shift
+
+
+# Codecs
+
+def _compile(cls):
+    """Field names of ``cls`` in to_dict, with a function returning their
+    values for an instance and one building an instance from them without
+    going through the __init__ chain of the mixins.
+    """
+    collection = issubclass(cls, CollectionDataobjectMixin)
+    new = object.__new__
+
+    if issubclass(cls, ParentkeyDataobjectMixin):
+        names = ("start", "end", "parent_key")
+
+        def values(obj):
+            interval = obj._interval
+            return interval.start, interval.end, obj._parent_key
+
+        def build(start, end, parent_key):
+            obj = new(cls)
+            obj._key = None
+            obj._interval = Interval(start, end)
+            obj._parent_key = parent_key
+            if collection:
+                obj._datastore = None
+            return obj
+    else:
+        names = tuple(cls._fields)
+        getter = attrgetter(*names)
+        if len(names) == 1:
+            values = lambda obj: (getter(obj), )
+        else:
+            values = getter
+
+        def build(*args):
+            obj = new(cls)
+            obj._key = None
+            if collection:
+                obj._datastore = None
+            for name, value in zip(names, args):
+                setattr(obj, name, value)
+            return obj
+
+    return names, values, build
+
+
+class Codec(object):
+    """Turns dataobjects into strings and back, without their keys.
+
+    Subclasses implement ``_encoder(cls)`` and ``_decoder(cls)``, which
+    return the functions for one class; they are compiled once per class.
+    """
+
+    def __init__(self):
+        self._encoders = {}
+        self._decoders = {}
+
+    def encode(self, obj):
+        try:
+            encoder = self._encoders[obj.__class__]
+        except KeyError:
+            encoder = self._encoders[obj.__class__] = self._encoder(obj.__class__)
+        return encoder(obj)
+
+    def decode(self, cls, payload):
+        try:
+            decoder = self._decoders[cls]
+        except KeyError:
+            decoder = self._decoders[cls] = self._decoder(cls)
+        return decoder(payload)
+
+
+class JSONCodec(Codec):
+    """The to_dict() object, as JSON."""
+
+    def _encoder(self, cls):
+        names, values, _ = _compile(cls)
+        dumps = json.dumps
+        return lambda obj: dumps(dict(zip(names, values(obj))))
+
+    def _decoder(self, cls):
+        names, _, build = _compile(cls)
+        loads = json.loads
+
+        def decode(payload):
+            d = loads(payload)
+            return build(*[d[name] for name in names])
+        return decode
+
+
+class MsgpackCodec(Codec):
+    """The to_dict() values as a msgpack array. Needs msgpack.
+
+    Strings are packed with the raw type, which the Redis scripts can
+    unpack, rather than as binary.
+    """
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("msgpack is not installed")
+        super(MsgpackCodec, self).__init__()
+
+    def _encoder(self, cls):
+        _, values, _ = _compile(cls)
+        packb = msgpack.packb
+        return lambda obj: packb(values(obj), use_bin_type=False)
+
+    def _decoder(self, cls):
+        _, _, build = _compile(cls)
+        unpackb = msgpack.unpackb
+        return lambda payload: build(*unpackb(payload))
+
+
+class StructCodec(Codec):
+    """The to_dict() values as fixed width little endian integers.
+
+    Parent keys must be integer strings. The default formats start with
+    the interval of shifts and appointments, as PackedRedisDatastore
+    scripts expect.
+    """
+
+    FORMATS = {
+        "Agenda": "<q",
+        "Shift": "<qqq",
+        "Appointment": "<qqq",
+    }
+
+    def __init__(self, formats=None):
+        super(StructCodec, self).__init__()
+        self.formats = formats or self.FORMATS
+
+    def _encoder(self, cls):
+        names, values, _ = _compile(cls)
+        pack = struct.Struct(self.formats[cls.__name__]).pack
+        if "parent_key" not in names:
+            return lambda obj: pack(*values(obj))
+
+        def encode(obj):
+            start, end, parent_key = values(obj)
+            return pack(start, end, int(parent_key))
+        return encode
+
+    def _decoder(self, cls):
+        names, _, build = _compile(cls)
+        unpack = struct.Struct(self.formats[cls.__name__]).unpack
+        if "parent_key" not in names:
+            return lambda payload: build(*unpack(payload))
+
+        def decode(payload):
+            start, end, parent_key = unpack(payload)
+            return build(start, end, str(parent_key))
+        return decode
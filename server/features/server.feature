@@ -60,3 +60,44 @@ Feature: Basic agenda manipulation
 		When I make an appointment today at 13:00
 		Then I fail
 
+	Scenario: List slots a page at a time
+		Given I have a shift tomorrow from 08:00 to 08:01
+		When I list slots of 30 seconds 20 at a time
+		Then I see 20 slots
+		When I get the next page of slots
+		Then I see 11 slots
+		And there are no more slots
+
+	Scenario: Reject slots of no length
+		Given I have a shift tomorrow from 08:00 to 08:01
+		When I list free slots of -5 seconds
+		Then I fail with 400
+
+	Scenario: List appointments
+		Given I have a shift tomorrow from 08:00 to 10:00
+		When I make an appointment tomorrow at 08:00
+		And I make an appointment tomorrow at 09:00
+		And I list appointments
+		Then I see 2 appointments
+		And the response is compact
+
+	Scenario: List appointments a page at a time
+		Given I have a shift tomorrow from 08:00 to 10:00
+		When I make an appointment tomorrow at 08:00
+		And I make an appointment tomorrow at 08:30
+		And I make an appointment tomorrow at 09:00
+		And I list appointments 2 at a time
+		Then I see 2 appointments
+		When I follow the next link
+		Then I see 1 appointments
+		And there are no more pages
+
+	Scenario: Poll appointments with their ETag
+		Given I have a shift tomorrow from 08:00 to 10:00
+		When I list appointments
+		And I list appointments again with its ETag
+		Then I succeed with 304
+		When I make an appointment tomorrow at 08:00
+		And I list appointments again with its ETag
+		Then I succeed with 200
+		And I see 1 appointments
@@ -92,3 +92,68 @@ def given_shifts(context):
             When I create a shift on {date} from {start} to {end}
         """.format(**d))
 
+
+@when(u'I list slots of {length} seconds {limit} at a time')
+def list_slots(context, length, limit):
+    context.slots_query = {'length': length, 'limit': limit}
+    context.response = context.client.get(
+        '/agendas/' + context.agenda_id + '/slots', context.slots_query)
+
+@when(u'I list free slots of {length} seconds')
+def list_free_slots(context, length):
+    context.response = context.client.get(
+        '/agendas/' + context.agenda_id + '/freeslots', {'length': length},
+        status="*")
+
+@when(u'I get the next page of slots')
+def next_slots(context):
+    params = dict(context.slots_query, after=context.response.json['next'])
+    context.response = context.client.get(
+        '/agendas/' + context.agenda_id + '/slots', params)
+
+@then(u'I see {count} slots')
+def see_slots(context, count):
+    slots = context.response.json['freeslots']
+    assert len(slots) == int(count), "{0} slots, not {1}".format(len(slots),
+                                                                 count)
+
+@then(u'there are no more slots')
+def no_more_slots(context):
+    assert 'next' not in context.response.json, "There is a next page"
+
+@when(u'I list appointments')
+def list_appointments(context):
+    context.response = context.client.get(
+        '/agendas/' + context.agenda_id + '/appointments')
+
+@then(u'I see {count} appointments')
+def see_appointments(context, count):
+    appos = context.response.json['appointments']
+    assert len(appos) == int(count), "{0} appointments, not {1}".format(
+                                                            len(appos), count)
+
+@then(u'the response is compact')
+def compact_response(context):
+    assert "\n" not in context.response.body and \
+        ": " not in context.response.body, "The response is indented"
+
+@when(u'I list appointments again with its ETag')
+def list_appointments_etag(context):
+    if context.response.status.startswith('200'):
+        context.etag = context.response.headers['ETag']
+    context.response = context.client.get(
+        '/agendas/' + context.agenda_id + '/appointments',
+        headers={'If-None-Match': context.etag}, status="*")
+
+@when(u'I list appointments {limit} at a time')
+def list_appointments_page(context, limit):
+    context.response = context.client.get(
+        '/agendas/' + context.agenda_id + '/appointments', {'limit': limit})
+
+@when(u'I follow the next link')
+def follow_next(context):
+    context.response = context.client.get(context.response.json['next'])
+
+@then(u'there are no more pages')
+def no_more_pages(context):
+    assert 'next' not in context.response.json, "There is a next page"
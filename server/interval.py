@@ -1,4 +1,14 @@
+from bisect import bisect_left, bisect_right
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
 class Interval(object):
+    __slots__ = ("start", "end")
+
     def __init__(self, start, end):
         self.start = start
         self.end = end
@@ -7,6 +17,9 @@ class Interval(object):
         return (other.start == self.start and
                 other.end == self.end)
 
+    def __ne__(self, other):
+        return not self == other
+
     def __contains__(self, other):
         return other.start >= self.start and other.end <= self.end
 
@@ -16,6 +29,64 @@ class Interval(object):
     def __repr__(self):
         return "<Interval(%s,%s)>" % (self.start, self.end)
 
+
+class IntervalIndex(object):
+    """Sorted sequence of non-overlapping intervals.
+
+    Intervals are kept ordered by start in a bisect-backed list, so
+    overlap queries cost O(log n) and, since no two intervals overlap,
+    ends are sorted too. Building one costs a sort, linear for intervals
+    given in order of start: it only pays off when it answers several
+    queries, like the bookings of a batch.
+    """
+
+    def __init__(self, intervals=()):
+        self._starts = []
+        self._intervals = []
+        for interval in sorted(intervals, key=lambda i: i.start):
+            if self._intervals and self._intervals[-1].end > interval.start:
+                raise ValueError("%r overlaps with %r" %
+                                 (interval, self._intervals[-1]))
+            self._starts.append(interval.start)
+            self._intervals.append(interval)
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def __iter__(self):
+        return iter(self._intervals)
+
+    def __repr__(self):
+        return "<IntervalIndex(%r)>" % self._intervals
+
+    def add(self, interval):
+        if self.overlaps(interval):
+            raise ValueError("%r overlaps with the index" % interval)
+        pos = bisect_right(self._starts, interval.start)
+        self._starts.insert(pos, interval.start)
+        self._intervals.insert(pos, interval)
+
+    def remove(self, interval):
+        pos = bisect_left(self._starts, interval.start)
+        if pos == len(self._intervals) or self._intervals[pos] != interval:
+            raise ValueError("%r not in index" % interval)
+        del self._starts[pos]
+        del self._intervals[pos]
+
+    def overlaps(self, interval):
+        # Only the last interval starting before ``interval`` ends can
+        # reach into it: it has the greatest end of all of them.
+        pos = bisect_left(self._starts, interval.end) - 1
+        return pos >= 0 and self._intervals[pos].overlaps(interval)
+
+    def overlapping(self, interval):
+        """Yield intervals overlapping ``interval`` in start order."""
+        pos = max(bisect_right(self._starts, interval.start) - 1, 0)
+        for i in self._intervals[pos:bisect_left(self._starts, interval.end)]:
+            if i.overlaps(interval):
+                yield i
+
+
 def slots_in_interval(length, interval, step=None):
     step = length if step == None else step
     return (Interval(s, s + length)
@@ -23,8 +94,103 @@ def slots_in_interval(length, interval, step=None):
             if s + length <= interval.end)
 
 
+def is_slot(interval, container, step):
+    """Whether ``interval`` is one of the slots of its length in
+    ``container``, as given by ``slots_in_interval``, in O(1).
+    """
+    return (container.start <= interval.start < container.end and
+            interval.end <= container.end and
+            (interval.start - container.start) % step == 0)
+
+
+def slot_starts_in_window(length, interval, step, start=None, end=None):
+    """Starts of the slots of ``slots_in_interval(length, interval, step)``
+    lying within ``start`` and ``end``, as an xrange.
+    """
+    first = interval.start
+    if start != None and start > first:
+        first += -((first - start) // step) * step
+    last = interval.end if end == None else min(interval.end, end)
+    return xrange(first, max(first, last - length + 1), step)
+
+
+def interval_difference(interval, intervals):
+    """Yield the parts of ``interval`` not covered by ``intervals``.
+
+    ``intervals`` must be sorted by start.
+    """
+    start = interval.start
+    for i in intervals:
+        if i.start > start:
+            yield Interval(start, min(i.start, interval.end))
+        start = max(start, i.end)
+        if start >= interval.end:
+            return
+    if start < interval.end:
+        yield Interval(start, interval.end)
+
+
+def slots_in_intervals(length, interval, intervals, step=None):
+    """Yield slots of ``interval`` wholly contained in one of ``intervals``.
+
+    Same slots as filtering ``slots_in_interval(length, interval, step)``
+    but in a single sweep: ``intervals`` are merged by start while the
+    greatest end reached so far tells whether the current slot fits.
+    Slots that cannot fit are skipped in one jump.
+    """
+    step = length if step == None else step
+    if length <= 0 or step <= 0:
+        # None, as from range, instead of a sweep that never ends
+        return
+    pending = iter(sorted(intervals, key=lambda i: i.start))
+    following = next(pending, None)
+    reach = float("-inf")
+    s = interval.start
+    while s + length <= interval.end:
+        while following is not None and following.start <= s:
+            reach = max(reach, following.end)
+            following = next(pending, None)
+        if reach >= s + length:
+            yield Interval(s, s + length)
+            s += step
+        elif following is None:
+            return
+        else:
+            # Next slot starting at or after the following interval
+            s += -(-(following.start - s) // step) * step
+
+
+def slot_starts_in_intervals(length, interval, intervals, step=None):
+    """Vectorized ``slots_in_intervals`` returning an int64 array of slot
+    starts. Requires numpy.
+    """
+    step = length if step == None else step
+    if length <= 0 or step <= 0:
+        return numpy.arange(0, dtype=numpy.int64)
+    starts = numpy.arange(interval.start, interval.end - length + 1, step,
+                          dtype=numpy.int64)
+    intervals = sorted(intervals, key=lambda i: i.start)
+    if not intervals or not len(starts):
+        return starts[:0]
+    interval_starts = numpy.array([i.start for i in intervals],
+                                  dtype=numpy.int64)
+    reach = numpy.maximum.accumulate(
+                numpy.array([i.end for i in intervals], dtype=numpy.int64))
+    last = numpy.searchsorted(interval_starts, starts, side="right") - 1
+    fits = (last >= 0) & (reach[numpy.maximum(last, 0)] >= starts + length)
+    return starts[fits]
+
+
+def slots_from_starts(starts, length):
+    """Yield an ``Interval`` for every start in an array of slot starts."""
+    for s in starts.tolist():
+        yield Interval(s, s + length)
+
+
 def interval_overlaps(interval, intervals):
+    if isinstance(intervals, IntervalIndex):
+        return intervals.overlaps(interval)
     for i in intervals:
         if interval.overlaps(i):
             return True
-    return False
\ No newline at end of file
+    return False
@@ -2,16 +2,20 @@
 
 from collections import OrderedDict
 
+import base64
 import calendar
 import datetime
 import json
 import time
+import types
+import urllib
 
 import pytz
 
 from bottle import Bottle, run, request, response, debug, HTTPResponse
 
-from agenda import ds, RedisDatastore, AgendaController, ShiftNotEmptyError, NotAvailableSlotError
+from agenda import ds, unit_of_work, common_free_slots, RedisDatastore, PackedRedisDatastore, CachedDatastore, AgendaController, ShiftNotEmptyError, NotAvailableSlotError
+from timeparse import parse_epoch
 
 # Settings
 
@@ -20,6 +24,47 @@ AUTH = ("user", "s3cr3ts3cr3t")
 DEFAULT_TZ = "Europe/Madrid"
 DEFAULT_PATH = "http://localhos:8008/agendas/shifts/%s"
 
+REDIS = {
+    "host": "127.0.0.1",
+    "port": 6379,
+    "db": 0,
+    # Takes precedence over host and port when set
+    "unix_socket_path": None,
+    "socket_timeout": None,
+    # Connections shared by all worker threads
+    "max_connections": 50,
+    # Wait up to blocking_timeout seconds for a free connection instead
+    # of failing when all of them are in use
+    "blocking": True,
+    "blocking_timeout": 20,
+    # Keys reserved per INCRBY on the key sequence
+    "block_size": 100,
+}
+
+# PackedRedisDatastore for the compact layout; convert existing data with
+# ``python admin.py migrate`` first
+DATASTORE_CLASS = RedisDatastore
+
+# Keyword arguments of CachedDatastore, e.g. {"max_size": 10000, "ttl": 30},
+# to cache agendas and shifts in each process; None to disable. Enable
+# keyspace notifications on the Redis server, notify-keyspace-events Kg$h,
+# for writes of other processes to evict cached objects before their ttl
+CACHE = None
+
+# Items per page of listings, unless asked for up to MAX_PAGE_SIZE
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Pretty printed JSON responses and debug mode of bottle. Otherwise
+# responses are compact and listings are streamed as they are encoded
+DEBUG = False
+
+# Bytes of JSON encoded before each chunk of a streamed response is sent
+CHUNK_SIZE = 8192
+
+# Rendered timestamps remembered by render_epoch
+EPOCH_MEMO_SIZE = 10000
+
 UTCTIMEFORMAT = "%Y-%m-%dT%H:%M:%SZ"
 LOCALTIMEFORMAT = "%Y-%m-%d %H:%M:%S"
 
@@ -27,14 +72,53 @@ LOCALTIMEFORMAT = "%Y-%m-%d %H:%M:%S"
 # Converters
 
 def epoch(a_dtstring):
-    tt = time.strptime(a_dtstring, UTCTIMEFORMAT)
-    return int(calendar.timegm(tt))
+    """Epoch of ``a_dtstring``, in UTCTIMEFORMAT or an epoch itself."""
+    return parse_epoch(a_dtstring, integers=True)
+
+
+DAY = 24 * 3600
+
+_timezones = {}
+_day_offsets = {}
+
+
+def get_timezone(zone):
+    """The pytz timezone named ``zone``, looked up once."""
+    try:
+        return _timezones[zone]
+    except KeyError:
+        return _timezones.setdefault(zone, pytz.timezone(zone))
+
+
+def utc_offset(an_epoch, zone):
+    """Seconds ``zone`` is ahead of UTC at ``an_epoch``.
+
+    The offset is computed once for the UTC day of ``an_epoch`` and reused
+    for every epoch of that day, unless the offset changes during it.
+    """
+    day = an_epoch // DAY
+    try:
+        offset = _day_offsets[(day, zone)]
+    except KeyError:
+        localtz = get_timezone(zone)
+        first, last = (epoch2datetime(day * DAY).astimezone(localtz),
+                       epoch2datetime(day * DAY + DAY - 1).astimezone(localtz))
+        offset = None
+        if first.utcoffset() == last.utcoffset():
+            offset = int(first.utcoffset().total_seconds())
+        if len(_day_offsets) >= EPOCH_MEMO_SIZE:
+            _day_offsets.clear()
+        _day_offsets[(day, zone)] = offset
+    if offset == None:
+        dt = epoch2datetime(an_epoch).astimezone(get_timezone(zone))
+        return int(dt.utcoffset().total_seconds())
+    return offset
 
 
 def today(context=None):
     context = context or {}
     zone = context.get("zone", DEFAULT_TZ)
-    localtz = pytz.timezone(zone)
+    localtz = get_timezone(zone)
     dt = datetime.date.today()
     dt = datetime.datetime.combine(dt, datetime.time(0))
     dt = dt.replace(tzinfo=localtz).astimezone(pytz.utc)
@@ -44,7 +128,7 @@ def today(context=None):
 def tomorrow(context=None):
     context = context or {}
     zone = context.get("zone", DEFAULT_TZ)
-    localtz = pytz.timezone(zone)
+    localtz = get_timezone(zone)
     dt = datetime.date.today() + datetime.timedelta(days=1)
     dt = datetime.datetime.combine(dt, datetime.time(0))
     dt = dt.replace(tzinfo=localtz).astimezone(pytz.utc)
@@ -55,6 +139,16 @@ def epoch2datetime(an_epoch):
     return datetime.datetime.utcfromtimestamp(an_epoch).replace(tzinfo=pytz.utc)
 
 
+def encode_cursor(obj):
+    """Opaque cursor of the listing page ending with ``obj``."""
+    return base64.urlsafe_b64encode(json.dumps([obj.interval.start, obj.key]))
+
+
+def decode_cursor(a_cursor):
+    start, key = json.loads(base64.urlsafe_b64decode(str(a_cursor)))
+    return (int(start), key)
+
+
 def filter_request(form_dict, name, to_python, default=None):
     try:
         return to_python(form_dict[name])
@@ -77,6 +171,49 @@ def require_authentication(fn):
 
 # Helpers
 
+_compact_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def iterencode(value):
+    """Encodes ``value`` as compact JSON, piece by piece.
+
+    Iterators within ``value``, like the listings of the render functions,
+    are encoded as arrays one item at a time, so the whole listing never
+    has to be in memory.
+    """
+    if isinstance(value, dict):
+        yield '{'
+        for i, (key, item) in enumerate(value.iteritems()):
+            yield (',' if i else '') + _compact_encoder.encode(key) + ':'
+            for piece in iterencode(item):
+                yield piece
+        yield '}'
+    elif hasattr(value, 'next'):
+        yield '['
+        for i, item in enumerate(value):
+            if i:
+                yield ','
+            for piece in iterencode(item):
+                yield piece
+        yield ']'
+    else:
+        yield _compact_encoder.encode(value)
+
+
+def chunks(pieces, size=None):
+    """Joins ``pieces`` of text into chunks of about ``size`` bytes."""
+    size = size or CHUNK_SIZE
+    chunk, length = [], 0
+    for piece in pieces:
+        chunk.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+
 def dict_to_response(items, status=200, headers=None):
     """Returns a HTTPResponse with ``items`` as a JSON.
 
@@ -85,30 +222,59 @@ def dict_to_response(items, status=200, headers=None):
     argument must each also be of one of those kinds, and each must in
     turn contain exactly two objects. The first is used as a key in the
     new dictionary, and the second as the key's value.
+
+    Values that are iterators are streamed as arrays in chunks, unless
+    DEBUG is set and the whole JSON is pretty printed. They are read in a
+    unit of work of their own (see with_unit_of_work), once the status
+    is sent: an error while streaming cuts the response short.
     """
-    headers = headers or {}
     payload = OrderedDict(items)
     payload["status"] = status
-    output = json.dumps(payload, indent=2)
-    for key, value in headers.iteritems():
-        response.headers[key] = value
-    response.set_header('Content-Type', 'application/json')
-    headers = {'Content-Type': 'application/json',
-               'Access-Control-Allow-Origin': '*', }
+    if DEBUG:
+        output = json.dumps(payload, indent=2, default=list)
+    else:
+        output = chunks(iterencode(payload))
+    # Headers of the global response are dropped by the HTTPResponse
+    headers = dict(headers or {})
+    headers.update({'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*', })
     return HTTPResponse(status=status, body=output, **headers)
 
 
+_rendered_epochs = {}
+
+
+def _format_epoch(an_epoch, zone):
+    """UTC and local time strings of ``an_epoch``, as UTCTIMEFORMAT and
+    LOCALTIMEFORMAT would render them.
+    """
+    utc = "%04d-%02d-%02dT%02d:%02d:%02dZ" % time.gmtime(an_epoch)[:6]
+    local = "%04d-%02d-%02d %02d:%02d:%02d" % time.gmtime(
+                                an_epoch + utc_offset(an_epoch, zone))[:6]
+    return utc, local
+
+
 def render_epoch(an_epoch, context=None):
+    """Rendered ``an_epoch``, shared by every caller rendering it in the
+    same zone: do not modify it.
+    """
     context = context or {}
     zone = context.get("zone", DEFAULT_TZ)
-    localtz = pytz.timezone(zone)
-    dt = epoch2datetime(an_epoch)
-    return OrderedDict((
-        ("datetime", dt.strftime(UTCTIMEFORMAT)),
+    try:
+        return _rendered_epochs[(an_epoch, zone)]
+    except KeyError:
+        pass
+    utc, local = _format_epoch(an_epoch, zone)
+    rendered = OrderedDict((
+        ("datetime", utc),
         ("timestamp", an_epoch),
-        ("localtime", dt.astimezone(localtz).strftime(LOCALTIMEFORMAT)),
+        ("localtime", local),
         ("timezone", zone)
     ))
+    if len(_rendered_epochs) >= EPOCH_MEMO_SIZE:
+        _rendered_epochs.clear()
+    _rendered_epochs[(an_epoch, zone)] = rendered
+    return rendered
 
 
 def render_shift(shift, context=None):
@@ -127,7 +293,7 @@ def render_shifts(shifts, context=None):
     context = context or {}
     return OrderedDict((
         ("kind", "shifts"),
-        ("shifts", [render_shift(shift, context) for shift in shifts])
+        ("shifts", (render_shift(shift, context) for shift in shifts))
     ))
 
 
@@ -154,7 +320,7 @@ def render_slots(slots, context=None):
     context = context or {}
     return OrderedDict((
         ("kind", "freeslots"),
-        ("freeslots", [render_slot(slot, context) for slot in slots])
+        ("freeslots", (render_slot(slot, context) for slot in slots))
     ))
 
 
@@ -162,7 +328,8 @@ def render_appointments(appos, context=None):
     context = context or {}
     return OrderedDict((
         ("kind", "appointments"),
-        ("appointments", [render_appointment(appo, context) for appo in appos])
+        ("appointments", (render_appointment(appo, context)
+                          for appo in appos))
     ))
 
 
@@ -178,6 +345,12 @@ def render_appointment(appo, context=None):
     ))
 
 
+def next_link(last):
+    """URL of the listing page following the one ending with ``last``."""
+    query = dict(request.query.items(), cursor=encode_cursor(last))
+    return Context(request).url + request.path + "?" + urllib.urlencode(query)
+
+
 def render_to_error(status, message):
     headers = {'Content-Type': 'application/json',
                'Access-Control-Allow-Origin': '*', }
@@ -195,6 +368,24 @@ def get_agenda_or_404(aid):
     return agenda
 
 
+def check_etag(agendas, *params):
+    """Returns the ETag of a representation of ``agendas``, at their current
+    versions, with ``params``.
+
+    Raises a 304 response instead when the client has it already, as told
+    by If-None-Match, so that the representation is not even computed.
+    """
+    etag = '"%s"' % ".".join(["%s-%s" % (agenda.key, agenda.version)
+                              for agenda in agendas] +
+                             [str(param) for param in params])
+    tags = [tag.strip() for tag in
+            request.headers.get("If-None-Match", "").split(",")]
+    if etag in tags or "W/" + etag in tags or "*" in tags:
+        headers = {'ETag': etag, 'Access-Control-Allow-Origin': '*', }
+        raise HTTPResponse(status=304, **headers)
+    return etag
+
+
 class Context(dict):
 
     def __init__(self, request, *args, **kwargs):
@@ -268,7 +459,8 @@ def test_post():
 @require_authentication
 def get_agenda(aid):
     agenda = get_agenda_or_404(aid)
-    return dict_to_response(render_agenda(agenda))
+    etag = check_etag([agenda])
+    return dict_to_response(render_agenda(agenda), headers={"ETag": etag})
 
 
 @require_authentication
@@ -285,35 +477,81 @@ def post_agenda():
 @require_authentication
 def get_slots(aid):
     length = filter_request(request.query, "length", int)
+    if length != None and length <= 0:
+        return render_to_error(400, "The length must be positive.")
     start_from = filter_request(request.query, "start", epoch)
     start_until = filter_request(request.query, "end", epoch)
+    after = filter_request(request.query, "after", epoch)
+    limit = filter_request(request.query, "limit", int) or PAGE_SIZE
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
     agenda = get_agenda_or_404(aid)
-    intervals = agenda.get_slots(length, start_from, start_until)
-    return dict_to_response(render_slots(intervals))
+    etag = check_etag([agenda])
+    intervals = list(agenda.get_slots(length, start_from, start_until,
+                                      limit + 1, after))
+    body = render_slots(intervals[:limit])
+    if len(intervals) > limit:
+        # Pass it as ``after`` to get the next page
+        body["next"] = epoch2datetime(intervals[limit - 1].start).strftime(
+                                                                UTCTIMEFORMAT)
+    return dict_to_response(body, headers={"ETag": etag})
 
 
 @require_authentication
 def get_free_slots(aid):
     length = filter_request(request.query, "length", int)
+    if length != None and length <= 0:
+        return render_to_error(400, "The length must be positive.")
     start = filter_request(request.query, "start", epoch) or today()
     end = filter_request(request.query, "end", epoch) or tomorrow()
     agenda = get_agenda_or_404(aid)
+    # Defaults of start and end change with the day
+    etag = check_etag([agenda], start, end)
     intervals = agenda.get_free_slots(start, end, length)
-    return dict_to_response(render_slots(intervals))
+    return dict_to_response(render_slots(intervals), headers={"ETag": etag})
+
+
+@require_authentication
+def get_common_free_slots():
+    try:
+        aids = [int(aid) for aid in request.query["agendas"].split(",")]
+    except (KeyError, ValueError):
+        return render_to_error(400, "A comma separated list of agendas is required.")
+    length = filter_request(request.query, "length", int)
+    if length != None and length <= 0:
+        return render_to_error(400, "The length must be positive.")
+    start = filter_request(request.query, "start", epoch) or today()
+    end = filter_request(request.query, "end", epoch) or tomorrow()
+    agendas = [get_agenda_or_404(aid) for aid in aids]
+    etag = check_etag(agendas, start, end)
+    intervals = common_free_slots(agendas, start, end, length)
+    return dict_to_response(render_slots(intervals), headers={"ETag": etag})
 
 
 @require_authentication
 def get_appointment(aid, app_id):
     agenda = get_agenda_or_404(aid)
+    etag = check_etag([agenda])
     appo = agenda.get_appointment(app_id)
-    return dict_to_response(render_appointment(appo))
+    return dict_to_response(render_appointment(appo), headers={"ETag": etag})
 
 
 @require_authentication
 def get_appointments(aid):
+    start = filter_request(request.query, "start", epoch)
+    end = filter_request(request.query, "end", epoch)
+    limit = filter_request(request.query, "limit", int) or PAGE_SIZE
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    after = filter_request(request.query, "cursor", decode_cursor, False)
+    if after == False:
+        return render_to_error(400, "Incorrect cursor.")
     agenda = get_agenda_or_404(aid)
-    appos = agenda.get_appointments_itervalues()
-    return dict_to_response(render_appointments(appos))
+    etag = check_etag([agenda])
+    appos = [appo for _, appo
+             in agenda.get_appointments_page(start, end, limit + 1, after)]
+    body = render_appointments(appos[:limit])
+    if len(appos) > limit:
+        body["next"] = next_link(appos[limit - 1])
+    return dict_to_response(body, headers={"ETag": etag})
 
 
 @require_authentication
@@ -328,16 +566,29 @@ def delete_appointment(aid, app_id):
 
 @require_authentication
 def get_shifts(aid):
+    start = filter_request(request.query, "start", epoch)
+    end = filter_request(request.query, "end", epoch)
+    limit = filter_request(request.query, "limit", int) or PAGE_SIZE
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    after = filter_request(request.query, "cursor", decode_cursor, False)
+    if after == False:
+        return render_to_error(400, "Incorrect cursor.")
     agenda = get_agenda_or_404(aid)
-    shifts = agenda.get_shifts_itervalues()
-    return dict_to_response(render_shifts(shifts))
+    etag = check_etag([agenda])
+    shifts = [shift for _, shift
+              in agenda.get_shifts_page(start, end, limit + 1, after)]
+    body = render_shifts(shifts[:limit])
+    if len(shifts) > limit:
+        body["next"] = next_link(shifts[limit - 1])
+    return dict_to_response(body, headers={"ETag": etag})
 
 
 @require_authentication
 def get_shift(aid, sid):
     agenda = get_agenda_or_404(aid)
+    etag = check_etag([agenda])
     shift = agenda.get_shift(sid)
-    return dict_to_response(render_shift(shift))
+    return dict_to_response(render_shift(shift), headers={"ETag": etag})
 
 
 @require_authentication
@@ -409,6 +660,32 @@ def setup_routing(app):
 
     app.route('/agendas/<aid:int>/slots', "GET", get_slots)
     app.route('/agendas/<aid:int>/freeslots', "GET", get_free_slots)
+    app.route('/freeslots', "GET", get_common_free_slots)
+
+
+def _streamed_in_unit_of_work(body):
+    with unit_of_work():
+        for piece in body:
+            yield piece
+
+
+def with_unit_of_work(callback):
+    """Plugin running each request in a unit of work of its own, and the
+    streamed body of its response in another one, as bottle reads it
+    after the callback returns.
+    """
+    def wrapper(*args, **kwargs):
+        with unit_of_work():
+            result = callback(*args, **kwargs)
+        if (isinstance(result, HTTPResponse) and
+                isinstance(result.body, types.GeneratorType)):
+            result.body = _streamed_in_unit_of_work(result.body)
+        return result
+    return wrapper
+
+
+def setup_plugins(app):
+    app.install(with_unit_of_work)
 
 
 def setup_error_handling(app):
@@ -417,11 +694,15 @@ def setup_error_handling(app):
 
 
 # Main
-debug(True)
+debug(DEBUG)
 
-setattr(ds, 'datastore', RedisDatastore())
+datastore = DATASTORE_CLASS(**REDIS)
+if CACHE:
+    datastore = CachedDatastore(datastore, **CACHE)
+setattr(ds, 'datastore', datastore)
 
 app = Bottle()
+setup_plugins(app)
 setup_routing(app)
 setup_error_handling(app)
 
@@ -0,0 +1,74 @@
+import unittest
+
+from admin import migrate, purge, rebuild
+from agenda import ds, k, AgendaController, RedisDatastore, PackedRedisDatastore
+from dataobjects import Agenda, Shift, Appointment
+
+
+class TestMigrate(unittest.TestCase):
+
+    def setUp(self):
+        # A database of its own, migrate converts all of it
+        self.source = RedisDatastore(db=1)
+        self.target = PackedRedisDatastore(
+            connection_pool=self.source.connection_pool)
+        self.source._rds.flushdb()
+
+    def tearDown(self):
+        self.source._rds.flushdb()
+        if hasattr(ds, 'datastore'):
+            delattr(ds, 'datastore')
+
+    def test_migrate(self):
+        agenda = self.source.put(Agenda(minimum_length=15))
+        shifts = [self.source.put(Shift(agenda.key, start, end))
+                  for start, end in ((9, 14), (16, 19))]
+        appointment = self.source.put(Appointment(shifts[0].key, 10, 12))
+        # Collections indexed before max lengths were kept
+        self.source._rds.delete(k(Agenda, agenda.key, Shift, "maxlen"))
+
+        self.assertEquals(migrate(self.source, self.target, count=2), 4)
+        self.assertEquals(migrate(self.source, self.target), 0)
+
+        rds = self.target._rds
+        self.assertEquals(rds.keys("*:end"), [])
+        self.assertEquals(rds.get(k(Agenda, agenda.key, Shift, "maxlen")), "5")
+        agenda = self.target.get(Agenda, agenda.key)
+        self.assertEquals(agenda.minimum_length, 15)
+        self.assertEquals([shift.interval for _, shift in agenda.iteritems()],
+                          [shift.interval for shift in shifts])
+        self.assertEquals([key for key, _ in agenda.iteritems_filter(10, 11)],
+                          [shifts[0].key])
+        self.assertEquals(
+            self.target.get(Appointment, appointment.key).interval,
+            appointment.interval)
+
+    def test_purge(self):
+        agenda = self.target.put(Agenda())
+        shift = self.target.put(Shift(agenda.key, 9, 14))
+        appointment = self.target.put(Appointment(shift.key, 10, 12))
+        # Left behind by a server stopped in the middle of the purge
+        self.target.purge = lambda cls, detached: None
+        self.target.delete_cascade(Agenda, agenda.key, background=True).join()
+        del self.target.purge
+
+        self.assertEquals(purge(self.target), 1)
+        self.assertEquals(self.target._rds.keys("*:deleting"), [])
+        with self.assertRaises(KeyError):
+            self.target.get(Appointment, appointment.key)
+        self.assertEquals(purge(self.target), 0)
+
+    def test_rebuild(self):
+        for datastore in (self.source, self.target):
+            datastore._rds.flushdb()
+            setattr(ds, 'datastore', datastore)
+            agenda = AgendaController(minimum_length=60)
+            agenda.add_shift(600, 1200)
+            agenda.add_appointment(600, 660)
+            datastore.availability.drop(agenda._agenda)
+
+            self.assertEquals(rebuild(datastore), 1)
+            gaps = datastore.availability.free_gaps(agenda._agenda, 0, 1200)
+            self.assertEquals([(gap.start, gap.end) for gap in gaps],
+                              [(660, 1200)])
+            self.assertEquals(rebuild(datastore, [agenda.key]), 1)
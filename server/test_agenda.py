@@ -1,8 +1,15 @@
+import random
 import unittest
 
-from agenda import (ds, RedisDatastore, AgendaController,
-                    NotAvailableSlotError, ShiftNotEmptyError)
-from interval import Interval
+import agenda as agenda_module
+from agenda import (ds, unit_of_work, common_free_slots, Datastore,
+                    RedisDatastore, PackedRedisDatastore,
+                    AgendaController, SortedCollection,
+                    NotAvailableSlotError, ShiftNotEmptyError,
+                    OverlappingIntervalWarning)
+from dataobjects import (Agenda, Shift, Appointment, JSONCodec, MsgpackCodec,
+                         StructCodec, msgpack)
+from interval import Interval, slots_in_interval, slots_in_intervals, numpy
 
 
 class TestAgenda(unittest.TestCase):
@@ -64,6 +71,70 @@ class TestAgenda(unittest.TestCase):
         agenda.del_shift(shift.key)
         agenda.destroy()
 
+    def test_add_many(self):
+        agenda = AgendaController()
+        shifts = agenda.add_shifts([(9, 14), (16, 19), (10, 12)])
+        self.assertEqual([s.interval for s in agenda.get_shifts_itervalues()],
+                         [Interval(9, 14), Interval(10, 12), Interval(16, 19)])
+        agenda.add_appointment(10, 11)
+
+        appos = agenda.add_appointments([(9, 10), (10, 11), (9, 10), (10, 11),
+                                         (20, 21), (16, 18)])
+        self.assertEqual([a.interval for a in appos[:2]],
+                         [Interval(9, 10), Interval(10, 11)])
+        self.assertEqual(appos[0].parent_key, shifts[0].key)
+        self.assertEqual(appos[1].parent_key, shifts[2].key)
+        for appo in appos[2:5]:
+            self.assertIsInstance(appo, NotAvailableSlotError)
+        self.assertEqual(appos[5].interval, Interval(16, 18))
+        self.assertEqual(len(list(agenda.get_appointments_itervalues())), 4)
+
+        for appo in list(agenda.get_appointments_itervalues()):
+            agenda.del_appointment(appo.key)
+        ds().delete_many(Shift, [s.key for s in shifts])
+        self.assertEqual(list(agenda.get_shifts_itervalues()), [])
+        agenda.destroy()
+
+    def test_put_again_checks_overlapping(self):
+        agenda = AgendaController()
+        shift = agenda.add_shift(0, 100)
+        agenda.add_appointment(0, 10)
+        appo = agenda.add_appointment(10, 20)
+
+        def moved(start, end):
+            obj = Appointment(shift.key, start, end)
+            obj.key = appo.key
+            return obj
+        with self.assertRaises(OverlappingIntervalWarning):
+            ds().put(moved(5, 20))
+        self.assertEqual(ds().put(moved(15, 20)).interval, Interval(15, 20))
+        self.assertEqual([a.interval for a
+                          in agenda.get_appointments_itervalues()],
+                         [Interval(0, 10), Interval(15, 20)])
+        agenda.destroy()
+
+    def test_put_many_checks_overlapping(self):
+        agenda = AgendaController()
+        shift = agenda.add_shift(9, 14)
+
+        appos = ds().put_many([Appointment(shift.key, 9, 11),
+                               Appointment(shift.key, 10, 12),
+                               Appointment("-1", 9, 10),
+                               Appointment(shift.key, 11, 12)])
+        self.assertEqual(appos[0].interval, Interval(9, 11))
+        self.assertIsInstance(appos[1], OverlappingIntervalWarning)
+        self.assertIsInstance(appos[2], KeyError)
+        self.assertEqual(appos[3].interval, Interval(11, 12))
+
+        with self.assertRaises(ShiftNotEmptyError):
+            ds().delete_many(Shift, [shift.key])
+        with self.assertRaises(KeyError):
+            ds().delete_many(Appointment, [appos[0].key, "-1"])
+        self.assertEqual(len(list(agenda.get_appointments_itervalues())), 2)
+        ds().delete_many(Appointment, [appos[0].key, appos[3].key])
+        self.assertEqual(list(agenda.get_appointments_itervalues()), [])
+        agenda.destroy()
+
     def test_all_appointments_in_agenda(self):
         agenda = AgendaController()
 
@@ -112,6 +183,20 @@ class TestAgenda(unittest.TestCase):
 
         agenda.destroy()
 
+    def test_shifts_in_time_order(self):
+        agenda = AgendaController()
+
+        for start, end in ((16, 19), (9, 14), (22, 24), (12, 17)):
+            agenda.add_shift(start, end)
+
+        self.assertEqual([s.interval.start for s in agenda.get_shifts_itervalues()],
+                         [9, 12, 16, 22])
+        self.assertEqual([s.interval.start for _, s
+                          in agenda.get_shifts_iteritems(13, 20)],
+                         [9, 12, 16])
+
+        agenda.destroy()
+
     def test_filter_appos(self):
         agenda = AgendaController()
 
@@ -159,6 +244,271 @@ class TestAgenda(unittest.TestCase):
 
         agenda.destroy()
 
+    def test_get_slots(self):
+        agenda = AgendaController(minimum_length=10)
+        for start, end in ((100, 150), (120, 170), (300, 330)):
+            agenda.add_shift(start, end)
+        agenda.add_appointment(100, 120)
+
+        def starts(*args, **kwargs):
+            return [slot.start for slot in agenda.get_slots(*args, **kwargs)]
+
+        self.assertEquals(starts(20), [100, 110, 120, 130, 140, 150,
+                                       300, 310])
+        self.assertEquals(starts(20, 115, 165), [120, 130, 140])
+        self.assertEquals(starts(), range(100, 170, 10) + [300, 310, 320])
+        self.assertEquals(list(agenda.get_slots(20, limit=1)),
+                          [Interval(100, 120)])
+
+        pages = []
+        after = None
+        while True:
+            page = starts(20, limit=3, after=after)
+            if not page:
+                break
+            pages.append(page)
+            after = page[-1]
+        self.assertEquals(pages, [[100, 110, 120], [130, 140, 150],
+                                  [300, 310]])
+
+        # Shifts are read in batches, as far as the slots need
+        batch_size = agenda_module.SHIFTS_BATCH_SIZE
+        agenda_module.SHIFTS_BATCH_SIZE = 1
+        get_shifts_page = agenda.get_shifts_page
+        batches = []
+
+        def get_batch(*args):
+            batches.append(args)
+            return get_shifts_page(*args)
+        agenda.get_shifts_page = get_batch
+        try:
+            self.assertEquals(starts(), range(100, 170, 10) + [300, 310, 320])
+            del batches[:]
+            self.assertEquals(starts(20, limit=1), [100])
+            self.assertEquals(len(batches), 2)
+        finally:
+            agenda_module.SHIFTS_BATCH_SIZE = batch_size
+        agenda.destroy()
+
+    def test_version(self):
+        agenda = AgendaController(minimum_length=10)
+        self.assertEquals(agenda.version, 1)
+        shift = agenda.add_shift(100, 200)
+        appo = agenda.add_appointment(100, 110)
+        agenda.add_appointments([(120, 130), (140, 150)])
+        self.assertEquals(agenda.version, 5)
+        list(agenda.get_free_slots(100, 200))
+        list(agenda.get_appointments_iteritems())
+        self.assertEquals(agenda.version, 5)
+        with self.assertRaises(NotAvailableSlotError):
+            agenda.add_appointment(100, 110)
+        self.assertEquals(agenda.version, 5)
+        agenda.del_appointment(appo.key)
+        agenda.minimum_length = 5
+        self.assertEquals(agenda.version, 7)
+        # Bumped by the datastore writes themselves
+        ds().put(Appointment(shift.key, 160, 170))
+        ds().delete_many(Appointment, [key for key, _ in shift.iteritems()])
+        ds().delete(Shift, shift.key)
+        self.assertEquals(agenda.version, 12)
+        other = AgendaController()
+        other.add_shift(100, 200)
+        self.assertEquals(AgendaController(agenda.key).version, 12)
+        agenda.destroy()
+        self.assertEquals(ds().get_version(Agenda, agenda.key), 0)
+        other.destroy()
+
+    def test_get_pages(self):
+        agenda = AgendaController(minimum_length=10)
+        for start, end in ((100, 200), (150, 300), (100, 130), (400, 500)):
+            agenda.add_shift(start, end)
+        for start in (100, 110, 160, 120, 170, 400, 180, 190, 250):
+            agenda.add_appointment(start, start + 10)
+
+        def pages(get_page, start=None, end=None):
+            pages = []
+            after = None
+            while True:
+                page = [obj for _, obj in get_page(start, end, 2, after)]
+                if not page:
+                    return pages
+                pages.append([obj.interval.start for obj in page])
+                after = (page[-1].interval.start, page[-1].key)
+
+        self.assertEquals(pages(agenda.get_shifts_page),
+                          [[100, 100], [150, 400]])
+        self.assertEquals(pages(agenda.get_shifts_page, 210, 450),
+                          [[150, 400]])
+        self.assertEquals(pages(agenda.get_appointments_page),
+                          [[100, 110], [120, 160], [170, 180], [190, 250],
+                           [400]])
+        self.assertEquals(pages(agenda.get_appointments_page, 115, 195),
+                          [[110, 120], [160, 170], [180, 190]])
+
+        # Shifts are read in batches, as far as the page needs
+        batch_size = agenda_module.SHIFTS_BATCH_SIZE
+        agenda_module.SHIFTS_BATCH_SIZE = 1
+        get_shifts_page = agenda.get_shifts_page
+        batches = []
+
+        def get_batch(*args):
+            batches.append(args)
+            return get_shifts_page(*args)
+        agenda.get_shifts_page = get_batch
+        try:
+            self.assertEquals(pages(agenda.get_appointments_page),
+                              [[100, 110], [120, 160], [170, 180], [190, 250],
+                               [400]])
+            del batches[:]
+            self.assertEquals(
+                [a.interval.start for _, a
+                 in agenda.get_appointments_page(None, None, 1)], [100])
+            # The two shifts at 100 and the one at 150, not the last one
+            self.assertEquals(len(batches), 3)
+        finally:
+            agenda_module.SHIFTS_BATCH_SIZE = batch_size
+        agenda.destroy()
+
+    def test_free_slots_match_slot_scan(self):
+        agenda = AgendaController()
+        rnd = random.Random(2012)
+        for _ in range(6):
+            start = rnd.randrange(0, 40)
+            agenda.add_shift(start, start + rnd.randrange(1, 12))
+        for _ in range(30):
+            start = rnd.randrange(0, 50)
+            try:
+                agenda.add_appointment(start, start + rnd.randrange(1, 3))
+            except NotAvailableSlotError:
+                pass
+
+        shifts = [s for _, s in agenda.get_shifts_iteritems()]
+        for start, end, length in ((0, 60, 1), (3, 47, 2), (5, 33, 3),
+                                   (10, 11, 1), (50, 60, 1)):
+            expected = []
+            for slot in slots_in_interval(length, Interval(start, end)):
+                for shift in shifts:
+                    appos = [a.interval for _, a in shift.iteritems()]
+                    if (slot in shift.interval and
+                        not any(slot.overlaps(a) for a in appos)):
+                        expected.append(slot)
+                        break
+            self.assertEqual(list(agenda.get_free_slots(start, end, length)),
+                             expected)
+
+        agenda.destroy()
+
+    def test_availability(self):
+        day = 24 * 3600
+        agenda = AgendaController(minimum_length=900)
+        rnd = random.Random(2013)
+        shifts = agenda.add_shifts(
+            (start, start + rnd.randrange(4, 40) * 900)
+            for start in [rnd.randrange(0, 3 * day, 900) for _ in range(8)])
+        # Across midnight
+        shifts.append(agenda.add_shift(day - 3600, day + 3600))
+        appos = []
+        for _ in range(60):
+            start = rnd.randrange(0, 3 * day, 900)
+            try:
+                appos.append(agenda.add_appointment(
+                    start, start + rnd.randrange(1, 4) * 900))
+            except NotAvailableSlotError:
+                pass
+        for appo in appos[::3]:
+            agenda.del_appointment(appo.key)
+        agenda.del_shift(agenda.add_shift(2 * day, 2 * day + 7200).key)
+
+        windows = ((0, day, 900), (day - 1800, day + 1800, 1800),
+                   (3600, 3 * day, 2700), (day // 2, 2 * day, 900))
+        kept = [list(agenda.get_free_slots(*window)) for window in windows]
+        availability = ds().availability
+        self.assertNotEquals(availability.free_gaps(agenda._agenda, 0, day),
+                             None)
+        availability.drop(agenda._agenda)
+        self.assertEquals(availability.free_gaps(agenda._agenda, 0, day),
+                          None)
+        self.assertEquals([list(agenda.get_free_slots(*window))
+                           for window in windows], kept)
+
+        agenda.rebuild_availability()
+        self.assertEquals([list(agenda.get_free_slots(*window))
+                           for window in windows], kept)
+
+        # Behind a write made without updating it
+        shift = agenda.add_shift(5 * day, 5 * day + 3600)
+        ds().put(Appointment(shift.key, 5 * day, 5 * day + 900))
+        self.assertEquals(availability.free_gaps(agenda._agenda, 0, day),
+                          None)
+        free = [Interval(5 * day + start, 5 * day + start + 900)
+                for start in (900, 1800, 2700)]
+        self.assertEquals(list(agenda.get_free_slots(5 * day, 6 * day, 900)),
+                          free)
+        agenda.rebuild_availability()
+        self.assertNotEquals(availability.free_gaps(agenda._agenda, 0, day),
+                             None)
+        self.assertEquals(list(agenda.get_free_slots(5 * day, 6 * day, 900)),
+                          free)
+
+        # Off the cells
+        agenda.add_shift(4 * day + 100, 4 * day + 1000)
+        self.assertEquals(availability.free_gaps(agenda._agenda, 0, day),
+                          None)
+        self.assertEquals(
+            list(agenda.get_free_slots(4 * day + 100, 5 * day, 900)),
+            [Interval(4 * day + 100, 4 * day + 1000)])
+        agenda.destroy()
+
+    def test_common_free_slots(self):
+        rnd = random.Random(2014)
+        agendas = []
+        for _ in range(3):
+            agenda = AgendaController(minimum_length=2)
+            agenda.add_shift(0, 50)
+            for _ in range(4):
+                start = rnd.randrange(0, 80, 2)
+                agenda.add_shift(start, start + rnd.randrange(2, 30, 2))
+            for _ in range(10):
+                start = rnd.randrange(0, 100, 2)
+                try:
+                    agenda.add_appointment(start, start + 2)
+                except NotAvailableSlotError:
+                    pass
+            agendas.append(agenda)
+
+        for start, end, length in ((0, 100, 2), (10, 60, 4), (0, 100, None)):
+            expected = None
+            for agenda in agendas:
+                free = set((slot.start, slot.end) for slot
+                           in agenda.get_free_slots(start, end, length or 2))
+                expected = free if expected == None else expected & free
+            self.assertTrue(expected)
+            expected = sorted(expected)
+            common = common_free_slots(agendas, start, end, length)
+            self.assertEquals([(slot.start, slot.end) for slot in common],
+                              expected)
+        for agenda in agendas:
+            agenda.destroy()
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_free_slot_starts(self):
+        agenda = AgendaController()
+        agenda.add_shift(9, 14)
+        agenda.add_shift(20, 2000)
+        agenda.add_appointment(10, 11)
+        agenda.add_appointment(1500, 1502)
+
+        for start, end, length in ((0, 20, 1), (0, 3000, 1), (7, 2500, 2)):
+            starts = agenda.get_free_slot_starts(start, end, length)
+            expected = list(slots_in_intervals(length, Interval(start, end),
+                                               agenda._free_gaps(start, end)))
+            self.assertEqual([Interval(s, s + length) for s in starts.tolist()],
+                             expected)
+            self.assertEqual(list(agenda.get_free_slots(start, end, length)),
+                             expected)
+
+        agenda.destroy()
+
     def test_minimum_length(self):
         agenda = AgendaController()
         agenda.minimum_length = 2
@@ -168,6 +518,83 @@ class TestAgenda(unittest.TestCase):
             agenda.add_appointment(11, 14)
 
 
+class TestSortedCollection(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = SortedCollection()
+        self.shifts = {}
+        for key, (start, end) in enumerate(((16, 19), (9, 14), (22, 24),
+                                            (12, 17), (9, 10))):
+            self.shifts[key] = Shift(None, start, end)
+            self.collection.add(key, self.shifts[key])
+
+    def test_iteritems(self):
+        self.assertEqual([key for key, _ in self.collection.iteritems()],
+                         [1, 4, 3, 0, 2])
+        self.assertEqual(len(self.collection), 5)
+
+    def test_iteritems_filter(self):
+        for start, end in ((0, 9), (9, 24), (10, 12), (14, 16), (17, 22),
+                           (18, 19), (24, 99), (None, 12), (17, None),
+                           (None, None)):
+            expected = [key for key, shift in self.collection.iteritems()
+                        if (end == None or shift.interval.start < end) and
+                           (start == None or shift.interval.end > start)]
+            self.assertEqual(
+                [key for key, _ in self.collection.iteritems_filter(start, end)],
+                expected, (start, end))
+
+    def test_iteritems_filter_pages(self):
+        keys = [key for key, _ in self.collection.iteritems_filter(10, None)]
+        pages = []
+        after = None
+        while True:
+            page = list(self.collection.iteritems_filter(10, None, after, 2))
+            if not page:
+                break
+            pages.extend(key for key, _ in page)
+            after = (page[-1][1].interval.start, page[-1][0])
+        self.assertEqual(pages, keys)
+
+    def test_remove(self):
+        self.collection.remove(3)
+        self.collection.add(4, Shift(None, 20, 21))
+        self.assertEqual([key for key, _ in self.collection.iteritems()],
+                         [1, 0, 4, 2])
+        self.assertEqual([key for key, _ in self.collection.iteritems_filter(14, 16)],
+                         [])
+        with self.assertRaises(KeyError):
+            self.collection.remove(3)
+
+
+class TestAgendaCodec(TestAgenda):
+
+    codec_class = JSONCodec
+
+    def setUp(self):
+        ds()
+        setattr(ds, 'datastore', Datastore(codec=self.codec_class()))
+
+    def test_update_keeps_key(self):
+        agenda = AgendaController(minimum_length=1800)
+        agenda.add_shift(0, 3600)
+        AgendaController(agenda.key).minimum_length = 900
+        agenda = AgendaController(agenda.key)
+        self.assertEquals(agenda.minimum_length, 900)
+        self.assertEquals(len(list(agenda.get_shifts_iteritems())), 1)
+
+
+@unittest.skipIf(msgpack is None, "msgpack is not installed")
+class TestAgendaMsgpackCodec(TestAgendaCodec):
+
+    codec_class = MsgpackCodec
+
+
+class TestAgendaStructCodec(TestAgendaCodec):
+
+    codec_class = StructCodec
+
+
 class TestAgendaRedis(TestAgenda):
 
     def setUp(self):
@@ -177,3 +604,126 @@ class TestAgendaRedis(TestAgenda):
     def tearDown(self):
         #ds()._rds.flushdb()
         delattr(ds, 'datastore')
+
+    def test_booking_cost_independent_of_history(self):
+        agenda = AgendaController(minimum_length=30)
+        agenda.add_shifts((day * 1440 + 540, day * 1440 + 840)
+                          for day in range(60))
+
+        round_trips = ds().round_trips
+        agenda.add_appointment(59 * 1440 + 600, 59 * 1440 + 630)
+        # Shifts in range, appointments in range, the booking with the
+        # version and its availability
+        self.assertEquals(ds().round_trips - round_trips, 4)
+
+        with self.assertRaises(NotAvailableSlotError):
+            agenda.add_appointment(59 * 1440 + 610, 59 * 1440 + 640)
+        agenda.destroy()
+
+
+class TestAgendaPackedRedis(TestAgendaRedis):
+
+    def setUp(self):
+        ds()
+        setattr(ds, 'datastore', PackedRedisDatastore())
+
+
+class TestUnitOfWork(unittest.TestCase):
+
+    def setUp(self):
+        ds()
+        setattr(ds, 'datastore', RedisDatastore())
+
+    def tearDown(self):
+        delattr(ds, 'datastore')
+
+    def test_identity_map(self):
+        agenda = AgendaController()
+        shift = agenda.add_shift(9 * 60, 14 * 60)
+        agenda.add_appointment(10 * 60, 11 * 60)
+        with unit_of_work():
+            agenda = AgendaController(agenda.key)
+            self.assertTrue(agenda.get_shift(shift.key) is
+                            agenda.get_shift(str(shift.key)))
+            slots = list(agenda.get_free_slots(9 * 60, 14 * 60, 60))
+            self.assertEquals(len(slots), 4)
+            appos = list(agenda.get_appointments_iteritems(9 * 60, 14 * 60))
+            round_trips = ds().round_trips
+            self.assertEquals(
+                list(agenda.get_appointments_iteritems(9 * 60, 14 * 60)),
+                appos)
+            self.assertEquals(ds().round_trips, round_trips)
+            # Bookings are seen at once
+            agenda.add_appointment(9 * 60, 10 * 60)
+            self.assertEquals(
+                len(list(agenda.get_free_slots(9 * 60, 14 * 60, 60))), 3)
+        agenda.destroy()
+
+    def test_listings_read_to_the_end(self):
+        agenda = AgendaController()
+        shift = agenda.add_shift(9 * 60, 14 * 60)
+        for start in range(9 * 60, 14 * 60, 60):
+            agenda.add_appointment(start, start + 30)
+        with unit_of_work():
+            shift = ds().get(Shift, shift.key)
+            appos = ds().collection_iteritems(shift)
+            first = next(appos)
+            self.assertTrue(ds().get(Appointment, first[0]) is first[1])
+            # Not kept while partly read
+            round_trips = ds().round_trips
+            self.assertEquals(len(list(ds().collection_iteritems(shift))), 5)
+            self.assertTrue(ds().round_trips > round_trips)
+            round_trips = ds().round_trips
+            self.assertEquals(len(list(ds().collection_iteritems(shift))), 5)
+            self.assertEquals(ds().round_trips, round_trips)
+            # Nor when written to while read
+            appos = ds().collection_iteritems(shift)
+            next(appos)
+            ds().put(Appointment(shift.key, 14 * 60 - 30, 14 * 60))
+            self.assertEquals(len(list(appos)), 4)
+            self.assertEquals(len(list(ds().collection_iteritems(shift))), 6)
+        agenda.destroy()
+
+    def test_controller_across_operations(self):
+        agenda = AgendaController(AgendaController().key)
+        self.assertEquals(list(agenda.get_shifts_itervalues()), [])
+        shift = agenda.add_shift(0, 100)
+        self.assertEquals([s.key for s in agenda.get_shifts_itervalues()],
+                          [shift.key])
+        self.assertEquals(list(agenda.get_appointments_itervalues()), [])
+        appo = agenda.add_appointment(0, 10)
+        self.assertEquals([a.key for a in agenda.get_appointments_itervalues()],
+                          [appo.key])
+        agenda.del_appointment(appo.key)
+        self.assertEquals(list(agenda.get_appointments_itervalues()), [])
+        agenda.destroy()
+
+    def test_buffered_writes(self):
+        agenda = AgendaController()
+        shift = agenda.add_shift(9 * 60, 14 * 60)
+        appo = agenda.add_appointment(10 * 60, 11 * 60)
+        with unit_of_work() as unit:
+            agenda.del_appointment(appo.key)
+            # Flushed at the end of the operation
+            self.assertEquals(unit._pending, [])
+            with self.assertRaises(KeyError):
+                ds().datastore.get(Appointment, appo.key)
+
+            ds().delete(Shift, shift.key)
+            self.assertEquals(agenda.get_shift(shift.key).key, shift.key)
+            unit.flush()
+            with self.assertRaises(KeyError):
+                agenda.get_shift(shift.key)
+
+            # Writes of failed operations are dropped
+            shift = agenda.add_shift(9 * 60, 14 * 60)
+            agenda.add_appointment(10 * 60, 11 * 60)
+            with self.assertRaises(ShiftNotEmptyError):
+                agenda.del_shift(shift.key)
+            with self.assertRaises(NotAvailableSlotError):
+                with unit_of_work():
+                    ds().put(Shift(agenda.key, 15 * 60, 16 * 60))
+                    agenda.add_appointment(10 * 60, 11 * 60)
+            self.assertEquals(unit._pending, [])
+            self.assertEquals(len(list(agenda.get_shifts_itervalues())), 1)
+        agenda.destroy()
@@ -1,6 +1,8 @@
+import json
 import unittest
 
-from dataobjects import Agenda, Shift, Appointment
+from dataobjects import (Agenda, Shift, Appointment, JSONCodec, MsgpackCodec,
+                         StructCodec, msgpack)
 from interval import Interval
 
 
@@ -33,3 +35,55 @@ class TestDataobject(unittest.TestCase):
             dict_b = obj_b.to_dict()
             self.assertEquals(dict_a, dict_b,
                 "Fails to_dict() from_dict() on %s" % obj_a.__class__)
+
+    def test_dataobjects_have_no_instance_dict(self):
+        for obj in (Agenda(), Shift(None, 9, 14), Appointment(None, 9, 10),
+                    Interval(9, 10)):
+            self.assertFalse(hasattr(obj, "__dict__"),
+                "%s has an instance dict" % obj.__class__)
+
+    def test_collection_iterates_through_datastore(self):
+        class FakeDatastore(object):
+            def collection_iteritems(self, obj):
+                return iter([("1", obj)])
+
+            def collection_iteritems_filter(self, obj, start=None, end=None):
+                return iter([(start, end)])
+
+        agenda = Agenda()
+        self.assertEquals(list(agenda.iteritems()), [])
+        self.assertEquals(list(agenda.iteritems_filter(9, 14)), [])
+        agenda.bind(FakeDatastore())
+        self.assertEquals(list(agenda.iteritems()), [("1", agenda)])
+        self.assertEquals(list(agenda.iteritems_filter(9, 14)), [(9, 14)])
+
+
+class TestCodecs(unittest.TestCase):
+
+    def assertRoundTrips(self, codec):
+        for obj in (Agenda(minimum_length=15), Shift("12", 9, 14),
+                    Appointment("34", 9, 10)):
+            copy = codec.decode(obj.__class__, codec.encode(obj))
+            self.assertEquals(copy.__class__, obj.__class__)
+            self.assertEquals(copy.to_dict(), obj.to_dict())
+            self.assertEquals(copy.key, None)
+        shift = codec.decode(Shift, codec.encode(Shift("12", 9, 14)))
+        self.assertEquals(list(shift.iteritems()), [])
+
+    def test_json_codec(self):
+        codec = JSONCodec()
+        self.assertRoundTrips(codec)
+        # Same payloads as to_dict()
+        appointment = Appointment("34", 9, 10)
+        payload = codec.encode(appointment)
+        self.assertEquals(Appointment.from_dict(json.loads(payload)).to_dict(),
+                          appointment.to_dict())
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    def test_msgpack_codec(self):
+        self.assertRoundTrips(MsgpackCodec())
+
+    def test_struct_codec(self):
+        codec = StructCodec()
+        self.assertRoundTrips(codec)
+        self.assertEquals(len(codec.encode(Appointment("34", 9, 10))), 24)
@@ -1,6 +1,9 @@
 import unittest
 
-from interval import Interval, slots_in_interval, interval_overlaps
+from interval import (Interval, IntervalIndex, is_slot, slots_in_interval,
+                      slots_in_intervals, slot_starts_in_intervals,
+                      slots_from_starts, interval_difference,
+                      interval_overlaps, numpy)
 
 
 class TestInterval(unittest.TestCase):
@@ -52,3 +55,98 @@ class TestOperations(unittest.TestCase):
 
         self.assertEquals(slots, [Interval(10, 11), Interval(12, 13)])
 
+    def test_is_slot(self):
+        shift = Interval(10, 20)
+        for step in (1, 2, 3):
+            for length in (1, 2, 5):
+                slots = list(slots_in_interval(length, shift, step))
+                for start in range(5, 25):
+                    interval = Interval(start, start + length)
+                    self.assertEquals(is_slot(interval, shift, step),
+                                      interval in slots)
+
+    def test_interval_difference(self):
+        shift = Interval(9, 14)
+        appointments = [Interval(9, 10), Interval(11, 12), Interval(13, 14)]
+
+        self.assertEqual(list(interval_difference(shift, appointments)),
+                         [Interval(10, 11), Interval(12, 13)])
+        self.assertEqual(list(interval_difference(shift, [])), [shift])
+        self.assertEqual(list(interval_difference(shift, [Interval(8, 15)])), [])
+
+    def test_slots_in_intervals(self):
+        interval = Interval(8, 20)
+        gaps = [Interval(16, 19), Interval(9, 11), Interval(10, 13)]
+
+        expected = [s for s in slots_in_interval(2, interval)
+                    if any(s in gap for gap in gaps)]
+        self.assertEqual(list(slots_in_intervals(2, interval, gaps)), expected)
+        self.assertEqual(list(slots_in_intervals(2, interval, gaps)),
+                         [Interval(10, 12), Interval(16, 18)])
+        self.assertEqual(list(slots_in_intervals(1, interval, gaps, 3)),
+                         [Interval(11, 12), Interval(17, 18)])
+        self.assertEqual(list(slots_in_intervals(1, interval, [])), [])
+        for length, step in ((-5, None), (0, 1), (2, 0), (2, -1)):
+            self.assertEqual(
+                list(slots_in_intervals(length, interval, gaps, step)), [])
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_slot_starts_in_intervals(self):
+        interval = Interval(8, 20)
+        gaps = [Interval(16, 19), Interval(9, 11), Interval(10, 13)]
+
+        for length, step in ((1, None), (2, None), (1, 3), (3, 1), (13, None)):
+            starts = slot_starts_in_intervals(length, interval, gaps, step)
+            self.assertEqual(starts.dtype, numpy.int64)
+            self.assertEqual(list(slots_from_starts(starts, length)),
+                             list(slots_in_intervals(length, interval, gaps, step)))
+        self.assertEqual(len(slot_starts_in_intervals(1, interval, [])), 0)
+        for length, step in ((-5, None), (0, 1), (2, 0), (2, -1)):
+            self.assertEqual(
+                len(slot_starts_in_intervals(length, interval, gaps, step)), 0)
+
+
+class TestIntervalIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.appointments = [Interval(13, 14), Interval(9, 10), Interval(11, 12)]
+        self.index = IntervalIndex(self.appointments)
+
+    def test_sorted(self):
+        self.assertEqual(list(self.index),
+                         [Interval(9, 10), Interval(11, 12), Interval(13, 14)])
+        self.assertEqual(len(self.index), 3)
+
+    def test_overlapping_intervals_rejected(self):
+        with self.assertRaises(ValueError):
+            IntervalIndex([Interval(9, 11), Interval(10, 12)])
+        with self.assertRaises(ValueError):
+            self.index.add(Interval(9, 12))
+
+    def test_overlaps(self):
+        for interval in (Interval(8, 20), Interval(9, 10), Interval(8, 10),
+                         Interval(13, 15), Interval(11, 13)):
+            self.assertTrue(self.index.overlaps(interval), interval)
+        for interval in (Interval(8, 9), Interval(10, 11), Interval(12, 13),
+                         Interval(14, 15)):
+            self.assertFalse(self.index.overlaps(interval), interval)
+
+    def test_overlapping(self):
+        self.assertEqual(list(self.index.overlapping(Interval(9, 12))),
+                         [Interval(9, 10), Interval(11, 12)])
+        self.assertEqual(list(self.index.overlapping(Interval(12, 13))), [])
+
+    def test_add_remove(self):
+        self.index.add(Interval(10, 11))
+        self.assertTrue(self.index.overlaps(Interval(10, 11)))
+        self.index.remove(Interval(11, 12))
+        self.assertFalse(self.index.overlaps(Interval(11, 12)))
+        with self.assertRaises(ValueError):
+            self.index.remove(Interval(11, 12))
+        self.assertEqual(list(self.index),
+                         [Interval(9, 10), Interval(10, 11), Interval(13, 14)])
+
+    def test_interval_overlaps_accepts_index(self):
+        for interval in (Interval(9, 12), Interval(12, 13)):
+            self.assertEqual(interval_overlaps(interval, self.index),
+                             interval_overlaps(interval, self.appointments))
@@ -1,7 +1,14 @@
+import threading
+import time
 import unittest
+import warnings
 
-from agenda import ds, RedisDatastore, OverlappingIntervalWarning
-from dataobjects import Agenda, Shift, Appointment
+import redis
+
+from agenda import (ds, k, RedisDatastore, PackedRedisDatastore, CachedDatastore,
+                    UnitOfWork, BlockingConnectionPool, KeyAllocator,
+                    OverlappingIntervalWarning, BUCKET_SIZE)
+from dataobjects import Agenda, Shift, Appointment, MsgpackCodec, msgpack
 
 
 class TestAgenda(unittest.TestCase):
@@ -73,3 +80,369 @@ class TestAgenda(unittest.TestCase):
 
         ds().delete(Shift, shift.key)
         ds().delete(Agenda, agenda.key)
+
+    def test_appointment_booking(self):
+        agenda = ds().put(Agenda())
+        shift = ds().put(Shift(agenda.key, 9, 14))
+
+        with self.assertRaises(KeyError):
+            ds().put(Appointment("missing", 9, 10))
+
+        ds()._rds.execute_command('SCRIPT', 'FLUSH')
+        appos = [ds().put(Appointment(shift.key, 10, 12))]
+        round_trips = ds().round_trips
+        appos.append(ds().put(Appointment(shift.key, 12, 13)))
+        # Just the script, the key comes from the reserved block
+        self.assertEquals(ds().round_trips - round_trips, 1)
+        appos.append(ds().put(Appointment(shift.key, 9, 10)))
+        for start, end in ((9, 11), (11, 12), (12, 14), (9, 14)):
+            with self.assertRaises(OverlappingIntervalWarning):
+                ds().put(Appointment(shift.key, start, end))
+        self.assertEquals(
+            [key for key, _ in ds().get(Shift, shift.key).iteritems()],
+            [appos[2].key, appos[0].key, appos[1].key])
+
+        for appo in appos:
+            ds().delete(Appointment, appo.key)
+        ds().delete(Shift, shift.key)
+        ds().delete(Agenda, agenda.key)
+
+    def test_range_query(self):
+        agenda = ds().put(Agenda())
+        shifts = [ds().put(Shift(agenda.key, start, end))
+                  for start, end in ((9, 14), (16, 19), (10, 30), (22, 24))]
+        agenda = ds().get(Agenda, agenda.key)
+
+        def keys_in(start, end):
+            return [key for key, _ in agenda.iteritems_filter(start, end)]
+
+        self.assertEquals(keys_in(15, 16), [shifts[2].key])
+        self.assertEquals(keys_in(19, 22), [shifts[2].key])
+        self.assertEquals(keys_in(13, 17),
+                          [shifts[0].key, shifts[2].key, shifts[1].key])
+        self.assertEquals(keys_in(None, 10), [shifts[0].key])
+        self.assertEquals(keys_in(24, None), [shifts[2].key])
+        self.assertEquals(keys_in(30, None), [])
+
+        # Collections indexed without a max length fall back to a full
+        # scan and get one on their next insert
+        ds()._rds.delete(k(Agenda, agenda.key, Shift, "maxlen"))
+        self.assertEquals(keys_in(19, 22), [shifts[2].key])
+        shifts.append(ds().put(Shift(agenda.key, 40, 41)))
+        self.assertEquals(ds()._rds.get(k(Agenda, agenda.key, Shift, "maxlen")),
+                          "20")
+        self.assertEquals(keys_in(19, 22), [shifts[2].key])
+
+        for shift in shifts:
+            ds().delete(Shift, shift.key)
+        ds().delete(Agenda, agenda.key)
+
+    def test_collection_round_trips(self):
+        setattr(ds, 'datastore', RedisDatastore(chunk_size=10))
+        agenda = ds().put(Agenda())
+        shift = ds().put(Shift(agenda.key, 0, 100))
+        appos = [ds().put(Appointment(shift.key, start, start + 1))
+                 for start in range(25)]
+        shift = ds().get(Shift, shift.key)
+
+        round_trips = ds().round_trips
+        items = shift.iteritems()
+        self.assertEquals(ds().round_trips, round_trips)
+        self.assertEquals([key for key, _ in items],
+                          [appo.key for appo in appos])
+        # One ZRANGEBYSCORE plus one MGET per chunk of ten
+        self.assertEquals(ds().round_trips - round_trips, 1 + 3)
+
+        list(shift.iteritems_filter(0, 1))
+        round_trips = ds().round_trips
+        self.assertEquals([key for key, _ in shift.iteritems_filter(5, 15)],
+                          [appo.key for appo in appos[5:15]])
+        # Keys and payloads come back from a single script call
+        self.assertEquals(ds().round_trips - round_trips, 1)
+
+        for appo in appos:
+            ds().delete(Appointment, appo.key)
+        ds().delete(Shift, shift.key)
+        ds().delete(Agenda, agenda.key)
+
+    def test_many_round_trips(self):
+        agenda = ds().put(Agenda())
+        round_trips = ds().round_trips
+        shifts = ds().put_many([Shift(agenda.key, start, start + 5)
+                                for start in range(0, 100, 5)])
+        self.assertEquals(ds().round_trips - round_trips, 1)
+        self.assertEquals([key for key, _ in agenda.iteritems()],
+                          [shift.key for shift in shifts])
+
+        round_trips = ds().round_trips
+        ds().delete_many(Shift, [shift.key for shift in shifts])
+        self.assertEquals(ds().round_trips - round_trips, 2)
+        self.assertEquals(list(agenda.iteritems()), [])
+        ds().delete(Agenda, agenda.key)
+
+    def build_agenda(self, shifts=3, appointments=4):
+        agenda = ds().put(Agenda())
+        objs = [agenda]
+        for shift in ds().put_many(Shift(agenda.key, i * 100, i * 100 + 50)
+                                   for i in range(shifts)):
+            objs.append(shift)
+            objs.extend(ds().put_many(
+                Appointment(shift.key, start, start + 10)
+                for start in range(shift.interval.start,
+                                   shift.interval.start + appointments * 10,
+                                   10)))
+        return objs
+
+    def assertDeleted(self, objs):
+        for obj in objs:
+            with self.assertRaises(KeyError):
+                ds().get(obj.__class__, obj.key)
+        self.assertEquals(ds()._rds.keys(k(Agenda, objs[0].key, "*")), [])
+        for obj in objs:
+            if isinstance(obj, Shift):
+                self.assertEquals(ds()._rds.keys(k(Shift, obj.key, "*")), [])
+
+    def test_delete_cascade(self):
+        objs = self.build_agenda()
+        shift = objs[1]
+        ds().delete_cascade(Shift, shift.key)
+        self.assertDeleted([shift] + objs[2:6])
+        self.assertEquals([key for key, _ in objs[0].iteritems()],
+                          [objs[6].key, objs[11].key])
+
+        round_trips = ds().round_trips
+        ds().delete_cascade(Agenda, objs[0].key)
+        self.assertEquals(ds().round_trips - round_trips, 1)
+        self.assertDeleted(objs)
+        with self.assertRaises(KeyError):
+            ds().delete_cascade(Agenda, objs[0].key)
+
+    def test_delete_cascade_background(self):
+        objs = self.build_agenda(shifts=5)
+        ds().chunk_size = 2
+        thread = ds().delete_cascade(Agenda, objs[0].key, background=True)
+        with self.assertRaises(KeyError):
+            ds().get(Agenda, objs[0].key)
+        thread.join()
+        self.assertDeleted(objs)
+
+    def test_key_allocator(self):
+        client = ds()._rds
+        client.delete("test.sequence", "test.sequence:0", "test.sequence:1")
+        allocator = KeyAllocator(client, "test.sequence", block_size=10)
+        round_trips = client.round_trips
+        self.assertEquals(allocator.allocate(3), ["1", "2", "3"])
+        self.assertEquals(allocator.allocate(10), [str(n) for n in range(4, 14)])
+        self.assertEquals(client.round_trips - round_trips, 2)
+        other = KeyAllocator(client, "test.sequence", block_size=10)
+        self.assertEquals(other.allocate(), ["21"])
+
+        sharded = KeyAllocator(client, "test.sequence", block_size=10,
+                               shards=2)
+        keys = sharded.allocate(3, hint="1") + sharded.allocate(3, hint="2")
+        self.assertEquals(len(set(keys)), 6)
+        self.assertEquals(len(set(int(key) % 2 for key in keys[:3])), 1)
+        self.assertEquals(len(set(int(key) % 2 for key in keys[3:])), 1)
+
+        keys = []
+
+        def worker():
+            for _ in range(50):
+                keys.extend(allocator.allocate())
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(set(keys)), 200)
+        client.delete("test.sequence", "test.sequence:0", "test.sequence:1")
+
+    def test_shared_connection_pool(self):
+        pool = BlockingConnectionPool(max_connections=2, timeout=5,
+                                      host='127.0.0.1', port=6379, db=0)
+        datastores = [RedisDatastore(connection_pool=pool) for _ in range(4)]
+        agenda = datastores[0].put(Agenda())
+        errors = []
+
+        def worker(datastore):
+            try:
+                for _ in range(20):
+                    datastore.get(Agenda, agenda.key)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(datastore, ))
+                   for datastore in datastores]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(errors, [])
+        self.assertTrue(len(pool._connections) <= 2)
+        datastores[1].delete(Agenda, agenda.key)
+
+    def test_non_blocking_pool_exhausted(self):
+        datastore = RedisDatastore(max_connections=1, blocking=False)
+        connection = datastore.connection_pool.get_connection('GET')
+        with self.assertRaises(redis.ConnectionError):
+            datastore.put(Agenda())
+        datastore.connection_pool.release(connection)
+        datastore.delete(Agenda, datastore.put(Agenda()).key)
+
+
+@unittest.skipIf(msgpack is None, "msgpack is not installed")
+class TestMsgpackRedisDatastore(TestAgenda):
+
+    def setUp(self):
+        ds()
+        setattr(ds, 'datastore', RedisDatastore(codec=MsgpackCodec()))
+
+
+class TestPackedRedisDatastore(TestAgenda):
+
+    def setUp(self):
+        ds()
+        setattr(ds, 'datastore', PackedRedisDatastore())
+
+    def test_layout(self):
+        agenda = ds().put(Agenda(minimum_length=5))
+        shift = ds().put(Shift(agenda.key, 10, 40))
+        appointment = ds().put(Appointment(shift.key, 15, 20))
+        rds = ds()._rds
+        for obj in (agenda, shift, appointment):
+            self.assertFalse(rds.exists(k(obj.__class__, obj.key)))
+            bucket = k(obj.__class__, "packed", int(obj.key) // BUCKET_SIZE)
+            self.assertTrue(rds.hexists(bucket, obj.key))
+        self.assertFalse(rds.exists(k(Shift, shift.key, Appointment, "end")))
+        self.assertEquals(ds().get(Agenda, agenda.key).minimum_length, 5)
+        self.assertEquals(ds().get(Appointment, appointment.key).interval,
+                          appointment.interval)
+        ds().delete(Appointment, appointment.key)
+        ds().delete(Shift, shift.key)
+        ds().delete(Agenda, agenda.key)
+
+
+class TestCachedDatastore(TestAgenda):
+
+    def setUp(self):
+        ds()
+        RedisDatastore()._rds.config_set("notify-keyspace-events", "Kg$h")
+        self.cache = CachedDatastore(RedisDatastore())
+        setattr(ds, 'datastore', self.cache)
+
+    def tearDown(self):
+        self.cache.close()
+        delattr(ds, 'datastore')
+
+    def wait_for(self, condition, timeout=2):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_hits_and_misses(self):
+        agenda = ds().put(Agenda())
+        shift = ds().put(Shift(agenda.key, 9, 14))
+        # Let the notifications of the puts arrive first
+        time.sleep(0.05)
+        for _ in range(3):
+            self.assertEquals(ds().get(Shift, shift.key).interval,
+                              shift.interval)
+        self.assertEquals((ds().hits, ds().misses), (2, 1))
+        # Not cached
+        appointment = ds().put(Appointment(shift.key, 9, 10))
+        ds().get(Appointment, appointment.key)
+        self.assertEquals((ds().hits, ds().misses), (2, 1))
+
+        ds().delete(Appointment, appointment.key)
+        ds().delete(Shift, shift.key)
+        with self.assertRaises(KeyError):
+            ds().get(Shift, shift.key)
+        ds().delete_cascade(Agenda, agenda.key)
+
+    def test_units_sharing_cached_objects(self):
+        agenda = ds().put(Agenda())
+        shift = ds().put(Shift(agenda.key, 0, 100))
+        time.sleep(0.05)
+        first, second = UnitOfWork(ds()), UnitOfWork(ds())
+        shift = first.get(Shift, shift.key)
+        self.assertTrue(second.get(Shift, shift.key) is shift)
+        self.assertEquals(list(second.collection_iteritems(shift)), [])
+        first.put(Appointment(shift.key, 0, 10))
+        first.put(Appointment(shift.key, 10, 20))
+        self.assertEquals(len(list(first.collection_iteritems(shift))), 2)
+        self.assertEquals(len(list(shift.iteritems())), 2)
+        ds().delete_cascade(Agenda, agenda.key)
+
+    def test_size_and_ttl(self):
+        cache = CachedDatastore(ds().datastore, max_size=2, ttl=0.2,
+                                listen=False)
+        agendas = [cache.put(Agenda()) for _ in range(3)]
+        for agenda in agendas:
+            cache.get(Agenda, agenda.key)
+        cache.get(Agenda, agendas[0].key)
+        cache.get(Agenda, agendas[2].key)
+        self.assertEquals((cache.hits, cache.misses), (1, 4))
+        time.sleep(0.3)
+        cache.get(Agenda, agendas[2].key)
+        self.assertEquals((cache.hits, cache.misses), (1, 5))
+        for agenda in agendas:
+            cache.delete_cascade(Agenda, agenda.key)
+
+    def test_ttl_only_without_notifications(self):
+        rds = RedisDatastore()._rds
+        rds.config_set("notify-keyspace-events", "")
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                cache = CachedDatastore(RedisDatastore())
+            self.assertEquals(len(caught), 1)
+            self.assertEquals(cache._pubsub, None)
+            self.assertEquals(rds.config_get("notify-keyspace-events")[
+                                            "notify-keyspace-events"], "")
+        finally:
+            rds.config_set("notify-keyspace-events", "Kg$h")
+
+    def test_eviction_while_reading(self):
+        agenda = ds().put(Agenda(minimum_length=5))
+        cache = CachedDatastore(ds().datastore, listen=False)
+        get = ds().datastore.get
+
+        def get_and_evict(cls, key):
+            obj = get(cls, key)
+            cache.evict(cls, key)
+            return obj
+
+        cache.datastore = type("Racing", (object, ), {})()
+        cache.datastore.get = get_and_evict
+        cache.get(Agenda, agenda.key)
+        self.assertNotIn((Agenda.__name__, str(agenda.key)), cache._entries)
+        cache.datastore = ds().datastore
+        cache.get(Agenda, agenda.key)
+        self.assertIn((Agenda.__name__, str(agenda.key)), cache._entries)
+        ds().delete_cascade(Agenda, agenda.key)
+
+    def test_invalidation_from_other_processes(self):
+        agenda = ds().put(Agenda(minimum_length=5))
+        self.assertEquals(ds().get(Agenda, agenda.key).minimum_length, 5)
+        other = RedisDatastore()
+        agenda.minimum_length = 10
+        other.put(agenda)
+        self.wait_for(
+            lambda: ds().get(Agenda, agenda.key).minimum_length == 10)
+        other.delete_cascade(Agenda, agenda.key)
+        self.wait_for(lambda: (Agenda.__name__, str(agenda.key))
+                              not in ds()._entries)
+
+    def test_invalidation_of_packed_buckets(self):
+        cache = CachedDatastore(PackedRedisDatastore())
+        agenda = cache.put(Agenda(minimum_length=5))
+        self.assertEquals(cache.get(Agenda, agenda.key).minimum_length, 5)
+        agenda.minimum_length = 10
+        PackedRedisDatastore().put(agenda)
+        self.wait_for(
+            lambda: cache.get(Agenda, agenda.key).minimum_length == 10)
+        cache.delete_cascade(Agenda, agenda.key)
+        cache.close()
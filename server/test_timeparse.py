@@ -0,0 +1,46 @@
+import calendar
+import datetime
+import random
+import time
+import unittest
+
+from pytz import utc
+
+from timeparse import TIMEFORMAT, parse_epoch, parse_datetime
+
+
+class TestTimeparse(unittest.TestCase):
+
+    def test_matches_strptime(self):
+        rnd = random.Random(2012)
+        for an_epoch in [0, -1, 951782400, 2 ** 31] + [
+                rnd.randrange(-2 ** 33, 2 ** 33) for _ in range(2000)]:
+            dt = datetime.datetime.utcfromtimestamp(an_epoch)
+            dtstring = "%04d-%02d-%02dT%02d:%02d:%02dZ" % dt.timetuple()[:6]
+            self.assertEquals(parse_epoch(dtstring), an_epoch, dtstring)
+            self.assertEquals(parse_epoch(dtstring),
+                calendar.timegm(time.strptime(dtstring, TIMEFORMAT)))
+            self.assertEquals(parse_datetime(dtstring),
+                              dt.replace(tzinfo=utc))
+
+    def test_integers(self):
+        self.assertEquals(parse_epoch("1350552600", integers=True),
+                          1350552600)
+        self.assertEquals(parse_epoch("-60", integers=True), -60)
+        self.assertEquals(parse_epoch("2012-10-18T09:30:00Z", integers=True),
+                          1350552600)
+        self.assertRaises(ValueError, parse_epoch, "1350552600")
+
+    def test_rejects_other_formats(self):
+        for dtstring in ("", "2012-10-18", "2012-10-18T09:30:00",
+                         "2012-10-18 09:30:00Z", "2012-10-18T09:30:00+00",
+                         "2012-1-18T09:30:00Z", "2012-10-18T9:30:00Z ",
+                         "2012-+1-18T09:30:00Z", "2012-13-18T09:30:00Z",
+                         "2012-00-18T09:30:00Z", "2013-02-29T09:30:00Z",
+                         "2012-10-32T09:30:00Z", "2012-10-18T24:00:00Z",
+                         "2012-10-18T09:60:00Z", "0000-10-18T09:30:00Z",
+                         "1.5", "-"):
+            self.assertRaises(ValueError, parse_epoch, dtstring, True)
+            self.assertRaises(ValueError, parse_datetime, dtstring)
+        self.assertEquals(parse_datetime("2012-02-29T09:30:00Z"),
+                          datetime.datetime(2012, 2, 29, 9, 30, tzinfo=utc))
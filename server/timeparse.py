@@ -0,0 +1,62 @@
+"""Parsing of the UTC datetimes of the API, like "2012-10-18T09:30:00Z",
+by slicing the fixed format instead of going through strptime.
+
+Shared by the server and the webclient, which imports this module
+from here (see webclient/webclient/settings.py).
+"""
+
+import datetime
+
+from pytz import utc
+
+
+TIMEFORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+_DAYS_IN_MONTH = (0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+_DAYS_BEFORE_MONTH = (0, 0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304,
+                      334)
+
+
+def _is_leap(year):
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+
+def parse_fields(a_dtstring):
+    """``(year, month, day, hour, minute, second)`` of ``a_dtstring``,
+    in TIMEFORMAT. Raises ValueError otherwise.
+    """
+    s = a_dtstring
+    if (len(s) != 20 or s[4] != "-" or s[7] != "-" or s[10] != "T" or
+            s[13] != ":" or s[16] != ":" or s[19] != "Z"):
+        raise ValueError("%r does not match %s" % (a_dtstring, TIMEFORMAT))
+    digits = s[0:4] + s[5:7] + s[8:10] + s[11:13] + s[14:16] + s[17:19]
+    if not digits.isdigit():
+        raise ValueError("%r does not match %s" % (a_dtstring, TIMEFORMAT))
+    year, month, day = int(s[0:4]), int(s[5:7]), int(s[8:10])
+    hour, minute, second = int(s[11:13]), int(s[14:16]), int(s[17:19])
+    if (year < 1 or not 1 <= month <= 12 or day < 1 or
+            day > _DAYS_IN_MONTH[month] + (month == 2 and _is_leap(year)) or
+            hour > 23 or minute > 59 or second > 59):
+        raise ValueError("%r is out of range" % a_dtstring)
+    return year, month, day, hour, minute, second
+
+
+def parse_epoch(a_dtstring, integers=False):
+    """Epoch of ``a_dtstring``, in TIMEFORMAT or, with ``integers``, an
+    epoch itself. Raises ValueError otherwise.
+    """
+    if integers and a_dtstring.lstrip("-").isdigit():
+        return int(a_dtstring)
+    year, month, day, hour, minute, second = parse_fields(a_dtstring)
+    before = year - 1
+    days = ((year - 1970) * 365 + before // 4 - before // 100 +
+            before // 400 - 477 + _DAYS_BEFORE_MONTH[month] +
+            (month > 2 and _is_leap(year)) + day - 1)
+    return ((days * 24 + hour) * 60 + minute) * 60 + second
+
+
+def parse_datetime(a_dtstring):
+    """Aware UTC datetime of ``a_dtstring``, in TIMEFORMAT. Raises
+    ValueError otherwise.
+    """
+    return datetime.datetime(*parse_fields(a_dtstring), tzinfo=utc)
@@ -1,9 +1,8 @@
-import datetime
-
 import requests
 import hammock
 
-from pytz import utc
+# server/timeparse.py, on the path set by the settings
+from timeparse import parse_datetime
 
 
 # Server settings 
@@ -20,7 +19,7 @@ FIELD_SEPARATOR = "_"
 # Conversion utilities
 
 def dtstring_to_datetime(dtstring):
-    return datetime.datetime.strptime(dtstring, TIMEFORMAT).replace(tzinfo=utc)
+    return parse_datetime(dtstring)
 
 
 def datetime_to_dtstring(dt):
@@ -1,10 +1,15 @@
 # Django settings for webclient project.
 import os.path
+import sys
 
 
 def here(*x):
     return os.path.join(os.path.abspath(os.path.dirname(__file__)), *x)
 
+# The timeparse module of the server is imported from there
+if here('..', '..', 'server') not in sys.path:
+    sys.path.append(here('..', '..', 'server'))
+
 DEBUG = False
 TEMPLATE_DEBUG = DEBUG
 